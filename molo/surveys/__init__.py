@@ -0,0 +1 @@
+default_app_config = 'molo.surveys.apps.SurveysAppConfig'
@@ -1,12 +1,25 @@
-from collections import defaultdict
+import bisect
+import calendar
 import datetime
+import threading
+from multiprocessing.pool import ThreadPool
 
 from wagtail_personalisation.adapters import SessionSegmentsAdapter
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
 from django.utils.dateparse import parse_datetime
+from django.utils.functional import cached_property
 from django.utils import timezone
 
-from molo.core.models import ArticlePage
+from molo.core.models import ArticlePage, ArticlePageTags, Tag
+from wagtail.wagtailcore.models import Page
 from .rules import CombinationRule
+from .segments import (
+    get_materialised_segment_ids,
+    is_materialisable,
+)
+from .tracing import evaluate_rule, trace
 
 
 def get_rule(rule_hash, data_structure):
@@ -42,7 +55,8 @@ def index_rules_by_type(rules):
     return indexed_rules
 
 
-def transform_into_boolean_list(stream_data, indexed_rules, request):
+def transform_into_boolean_list(stream_data, indexed_rules, request,
+                                results=None):
     '''
     Converts a stream field of strings and rules into a list
     of booleans (evaluated rule evaluations), strings and nested lists
@@ -60,12 +74,22 @@ def transform_into_boolean_list(stream_data, indexed_rules, request):
 
     Output:
     [True, 'and', [False, 'or', True]]
+
+    Rules found in ``results``, a dict of results by rule id(), are not
+    evaluated again.
     '''
+    results = results or {}
+
+    def test_user(rule):
+        if id(rule) in results:
+            return results[id(rule)]
+        return evaluate_rule(rule, request)
+
     return_value = []
     for block in stream_data:
         if block['type'] == 'Rule':
             rule = get_rule(block['value'], indexed_rules)
-            return_value.append(rule.test_user(request))
+            return_value.append(test_user(rule))
         elif block['type'] == 'Operator':
             return_value.append(block['value'])
         elif block['type'] == 'NestedLogic':
@@ -73,14 +97,128 @@ def transform_into_boolean_list(stream_data, indexed_rules, request):
             rule_1 = get_rule(values['rule_1'], indexed_rules)
             rule_2 = get_rule(values['rule_2'], indexed_rules)
             return_value.append([
-                rule_1.test_user(request),
+                test_user(rule_1),
                 values['operator'],
-                rule_2.test_user(request)
+                test_user(rule_2)
             ])
 
     return return_value
 
 
+_rule_pool = None
+_rule_pool_lock = threading.Lock()
+
+
+def get_rule_pool():
+    """
+    Thread pool for evaluating rules concurrently, sized by the
+    SURVEYS_PARALLEL_RULE_THREADS setting. Disabled when it is 0.
+    """
+    global _rule_pool
+
+    size = getattr(settings, 'SURVEYS_PARALLEL_RULE_THREADS', 0)
+    if not size:
+        return None
+
+    with _rule_pool_lock:
+        if _rule_pool is None:
+            _rule_pool = ThreadPool(size)
+    return _rule_pool
+
+
+def close_if_unusable(connection):
+    """
+    Close a connection left unusable by an error or a leaked transaction.
+    Unlike ``close_if_unusable_or_obsolete`` it ignores CONN_MAX_AGE, so
+    pool threads keep their connections for their whole lifetime instead
+    of opening a new one for every rule.
+    """
+    if connection.connection is None:
+        return
+    if connection.get_autocommit() != connection.settings_dict['AUTOCOMMIT']:
+        connection.close()
+    elif connection.errors_occurred:
+        if connection.is_usable():
+            connection.errors_occurred = False
+        else:
+            connection.close()
+
+
+def _evaluate_rule_in_thread(args):
+    rule, request = args
+    try:
+        return evaluate_rule(rule, request)
+    finally:
+        for connection in connections.all():
+            close_if_unusable(connection)
+
+
+def evaluate_rules_concurrently(rules, request):
+    """
+    Evaluate the rules that only read stored user data on the rule pool
+    and return their results by rule id(). Rules depending on the session
+    are left to be evaluated in the request's thread.
+    """
+    pool = get_rule_pool()
+    parallel_rules = [
+        rule for rule in rules
+        if getattr(rule, 'materialisable', False) and
+        not isinstance(rule, CombinationRule)
+    ]
+    if pool is None or len(parallel_rules) < 2:
+        return {}
+    if any(connection.in_atomic_block for connection in connections.all()):
+        # Pool threads use their own connections and can't see the writes
+        # of the request's transaction, e.g. with ATOMIC_REQUESTS
+        return {}
+
+    # Resolve the lazy user before it is shared between threads
+    getattr(request.user, 'pk', None)
+
+    results = pool.map(
+        _evaluate_rule_in_thread,
+        [(rule, request) for rule in parallel_rules],
+    )
+    return dict(zip([id(rule) for rule in parallel_rules], results))
+
+
+def evaluate_rules(rules, request, match_any=False):
+    if not rules:
+        return False
+
+    results = evaluate_rules_concurrently(rules, request)
+
+    def test_user(rule):
+        if id(rule) in results:
+            return results[id(rule)]
+        return evaluate_rule(rule, request)
+
+    bool_rules = [rule for rule in rules
+                  if isinstance(rule, CombinationRule)]
+
+    if not bool_rules:
+        if match_any:
+            return any(test_user(rule) for rule in rules)
+        return all(test_user(rule) for rule in rules)
+    else:
+        # evaluates only 1 rule
+        rule_combo = bool_rules[0]
+
+        simple_rules = [rule for rule in rules
+                        if not isinstance(rule, CombinationRule)]
+
+        rules_indexed_by_type_name = index_rules_by_type(simple_rules)
+
+        nested_list_of_booleans = transform_into_boolean_list(
+            rule_combo.body.stream_data,
+            rules_indexed_by_type_name,
+            request,
+            results,
+        )
+
+        return evaluate(nested_list_of_booleans)
+
+
 def evaluate(list_):
     '''
     Function that evaluates a list of boolean values
@@ -104,22 +242,193 @@ def evaluate(list_):
         return evaluate([evaluate(list_[:3])] + list_[3:])
 
 
+ARTICLE_TAGS_CACHE_KEY = 'molo.surveys.article_tags.%s'
+
+
+def get_article_tags_cache_timeout():
+    return getattr(settings, 'SURVEYS_ARTICLE_TAGS_CACHE_TIMEOUT', 60 * 60)
+
+
+def get_article_tag_ids(page):
+    """
+    Return the ids of the article's tags, cached until it is published, its
+    tags are removed or the cache timeout.
+    """
+    cache_key = ARTICLE_TAGS_CACHE_KEY % page.pk
+    tag_ids = cache.get(cache_key)
+    if tag_ids is None:
+        tag_ids = cache_article_tag_ids(page)
+    return tag_ids
+
+
+def cache_article_tag_ids(page):
+    tag_ids = list(
+        ArticlePageTags.objects.filter(
+            page_id=page.pk, tag__isnull=False,
+        ).values_list('tag_id', flat=True)
+    )
+    cache.set(ARTICLE_TAGS_CACHE_KEY % page.pk, tag_ids,
+              get_article_tags_cache_timeout())
+    return tag_ids
+
+
+def invalidate_article_tag_ids(page_ids):
+    cache.delete_many([ARTICLE_TAGS_CACHE_KEY % page_id
+                       for page_id in page_ids])
+
+
+def to_timestamp(value):
+    """Seconds since the epoch, treating naive datetimes as UTC."""
+    if timezone.is_naive(value):
+        value = timezone.make_aware(value, timezone.utc)
+    return calendar.timegm(value.utctimetuple())
+
+
+def to_utc_date(value):
+    if timezone.is_aware(value):
+        value = value.astimezone(timezone.utc)
+    return value.date()
+
+
+def timestamp_to_utc_date(timestamp):
+    return datetime.datetime.utcfromtimestamp(timestamp).date()
+
+
+def get_tag_visit_timestamp(visits, page_key):
+    """Timestamp of the latest visit of the page, or None."""
+    try:
+        return visits['t'][visits['p'].index(page_key)]
+    except ValueError:
+        return None
+
+
+def add_tag_visit(visits, page_key, timestamp, max_visits):
+    """
+    Record the visit of a page in a tag's visits and return whether the
+    page had not been visited before.
+
+    ``visits`` holds the visited pages and their latest visit timestamps in
+    two lists sorted by time. Only the latest ``max_visits`` pages are kept.
+    """
+    pages, timestamps = visits['p'], visits['t']
+    is_new = page_key not in pages
+    if not is_new:
+        index = pages.index(page_key)
+        del pages[index]
+        del timestamps[index]
+
+    index = bisect.bisect_right(timestamps, timestamp)
+    pages.insert(index, page_key)
+    timestamps.insert(index, timestamp)
+
+    excess = len(timestamps) - max_visits
+    if excess > 0:
+        del pages[:excess]
+        del timestamps[:excess]
+
+    return is_new
+
+
+def count_tag_visits(visits, date_from, date_to):
+    timestamps = visits['t']
+    return (bisect.bisect_right(timestamps, to_timestamp(date_to)) -
+            bisect.bisect_left(timestamps, to_timestamp(date_from)))
+
+
 class SurveysSegmentsAdapter(SessionSegmentsAdapter):
+    tag_visits_session_key = 'tag_count'
+    # Id of the user the session's tag visits were stored for
+    tag_visits_user_session_key = 'tag_count_user'
+
+    def user_is_authenticated(self):
+        user = getattr(self.request, 'user', None)
+        return user is not None and user.is_authenticated()
+
+    def get_tag_visits(self):
+        tag_visits = self.request.session.setdefault(
+            self.tag_visits_session_key, {})
+
+        for tag_id, visits in tag_visits.items():
+            if 't' not in visits:
+                # Convert visits stored as {page path: ISO datetime}
+                ordered = sorted(
+                    (to_timestamp(parse_datetime(visit_time)), path)
+                    for path, visit_time in visits.items()
+                )
+                tag_visits[tag_id] = {
+                    'p': [path for timestamp, path in ordered],
+                    't': [timestamp for timestamp, path in ordered],
+                }
+                self.request.session.modified = True
+
+        return tag_visits
+
+    def sync_tag_visits(self):
+        """
+        Store the tag visits in the session of a logged-in user in the
+        database, once per session, so visits made before logging in are
+        counted with the user's other visits.
+        """
+        user_id = self.request.user.pk
+        session = self.request.session
+        if session.get(self.tag_visits_user_session_key) == user_id:
+            return
+        session[self.tag_visits_user_session_key] = user_id
+
+        tag_visits = self.get_tag_visits()
+        paths = set(
+            path for visits in tag_visits.values() for path in visits['p'])
+        if not paths:
+            return
+
+        page_ids = dict(
+            Page.objects.filter(path__in=paths).values_list('path', 'pk'))
+        tag_ids = set(
+            Tag.objects.filter(
+                pk__in=[int(tag_id) for tag_id in tag_visits],
+            ).values_list('pk', flat=True))
+
+        from .models import ArticleTagVisit
+
+        ArticleTagVisit.record_visits(user_id, [
+            (int(tag_id), page_ids[path], timestamp_to_utc_date(timestamp))
+            for tag_id, visits in tag_visits.items()
+            if int(tag_id) in tag_ids
+            for path, timestamp in zip(visits['p'], visits['t'])
+            if path in page_ids
+        ])
+
     def add_page_visit(self, page):
         super(SurveysSegmentsAdapter, self).add_page_visit(page)
-        tag_visits = self.request.session.setdefault(
-            'tag_count',
-            defaultdict(dict),
-        )
-        if isinstance(page.specific, ArticlePage):
-            # Set the datetime based on UTC
-            visit_time = datetime.datetime.now(timezone.utc).isoformat()
-            for nav_tag in page.nav_tags.all():
-                tag_visits.setdefault(str(nav_tag.tag.id), dict())
-                tag_visits[str(nav_tag.tag.id)][page.path] = visit_time
+        tag_visits = self.get_tag_visits()
+        if issubclass(page.specific_class, ArticlePage):
+            max_visits = getattr(settings, 'SURVEYS_TAG_VISITS_PER_TAG', 200)
+            # Set the timestamp based on UTC
+            now = timezone.now()
+            visit_time = to_timestamp(now)
+            today = to_utc_date(now)
+            changed_tag_ids = []
+            for tag_id in get_article_tag_ids(page):
+                visits = tag_visits.setdefault(
+                    str(tag_id), {'p': [], 't': []})
+                previous_time = get_tag_visit_timestamp(visits, page.path)
+                add_tag_visit(visits, page.path, visit_time, max_visits)
+                if previous_time is None or \
+                        timestamp_to_utc_date(previous_time) != today:
+                    changed_tag_ids.append(tag_id)
+                self.request.session.modified = True
+
+            if changed_tag_ids and self.user_is_authenticated():
+                # Keep the visits of logged-in users across sessions
+                from .models import ArticleTagVisit
+
+                self.sync_tag_visits()
+                ArticleTagVisit.record_visits(self.request.user.pk, [
+                    (tag_id, page.pk, today) for tag_id in changed_tag_ids
+                ])
 
     def get_tag_count(self, tag, date_from=None, date_to=None):
-        """Return the number of visits on the given page"""
+        """Return the number of visited pages with the given tag"""
         if not date_from:
             date_from = timezone.make_aware(
                 datetime.datetime.min,
@@ -131,41 +440,47 @@ class SurveysSegmentsAdapter(SessionSegmentsAdapter):
                 timezone.utc,
             )
 
-        tag_visits = self.request.session.setdefault(
-            'tag_count',
-            defaultdict(dict),
-        )
+        if self.user_is_authenticated():
+            from .models import ArticleTagVisit
 
-        visits = tag_visits.get(str(tag.id), dict())
-        valid_visits = [visit for visit in visits.values()
-                        if date_from <= parse_datetime(visit) <= date_to]
-        return len(valid_visits)
+            self.sync_tag_visits()
+            return ArticleTagVisit.objects.filter(
+                user_id=self.request.user.pk,
+                tag_id=tag.id,
+                date__gte=to_utc_date(date_from),
+                date__lte=to_utc_date(date_to),
+            ).count()
 
-    def _test_rules(self, rules, request, match_any=False):
-        if not rules:
-            return False
+        visits = self.get_tag_visits().get(str(tag.id))
+        if not visits:
+            return 0
+        return count_tag_visits(visits, date_from, date_to)
 
-        bool_rules = False
-        bool_rules = [rule for rule in rules
-                      if isinstance(rule, CombinationRule)]
+    @cached_property
+    def materialised_segment_ids(self):
+        return get_materialised_segment_ids()
 
-        if not bool_rules:
-            if match_any:
-                return any(rule.test_user(request) for rule in rules)
-            return all(rule.test_user(request) for rule in rules)
-        else:
-            # evaluates only 1 rule
-            rule_combo = bool_rules[0]
+    @cached_property
+    def materialised_memberships(self):
+        """Segment ids the user is a materialised member of."""
+        from .models import SegmentMembership
 
-            simple_rules = [rule for rule in rules
-                            if not isinstance(rule, CombinationRule)]
+        return frozenset(
+            SegmentMembership.objects.filter(
+                user_id=self.request.user.pk,
+            ).values_list('segment_id', flat=True)
+        )
 
-            rules_indexed_by_type_name = index_rules_by_type(simple_rules)
+    def _test_rules(self, rules, request, match_any=False):
+        if not rules:
+            return False
 
-            nested_list_of_booleans = transform_into_boolean_list(
-                rule_combo.body.stream_data,
-                rules_indexed_by_type_name,
-                request
-            )
+        # Read memberships of logged-in users from the materialised table
+        # when the whole segment has been evaluated in the background.
+        if request.user.is_authenticated() and is_materialisable(rules) and \
+                rules[0].segment_id in self.materialised_segment_ids:
+            return rules[0].segment_id in self.materialised_memberships
 
-            return evaluate(nested_list_of_booleans)
+        return trace(
+            lambda: evaluate_rules(rules, request, match_any=match_any),
+            rules[0].segment_id, 'Segment', rules[0].segment_id, request)
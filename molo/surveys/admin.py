@@ -1,3 +1,6 @@
+from django.core.urlresolvers import reverse
+from django.utils.html import format_html
+from django.utils.translation import ugettext_lazy as _
 from wagtail.contrib.modeladmin.options import ModelAdmin
 
 from .models import SegmentUserGroup
@@ -9,5 +12,12 @@ class SegmentUserGroupAdmin(ModelAdmin):
     menu_icon = 'group'
     menu_order = 1
     add_to_settings_menu = True
-    list_display = ('name',)
+    list_display = ('name', 'import_csv')
     search_fields = ('name',)
+
+    def import_csv(self, obj):
+        return format_html(
+            '<a class="button button-small button-secondary" href="{}">{}</a>',
+            reverse('segment-user-group-import', args=(obj.pk,)),
+            _('Import users from CSV'))
+    import_csv.short_description = _('Import')
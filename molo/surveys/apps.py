@@ -0,0 +1,11 @@
+from django.apps import AppConfig
+
+
+class SurveysAppConfig(AppConfig):
+    name = 'molo.surveys'
+    label = 'surveys'
+
+    def ready(self):
+        from .rules import rule_registry
+
+        rule_registry.populate()
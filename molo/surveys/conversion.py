@@ -0,0 +1,128 @@
+import json
+
+from django.core.cache import cache
+from django.db import transaction
+
+from wagtail.wagtailcore.models import Page
+from wagtail.wagtailcore.utils import cautious_slugify
+from wagtail.wagtailsearch.backends import get_search_backends
+
+from molo.core.models import ArticlePage
+
+
+CONVERSION_PROGRESS_CACHE_KEY = 'molo.surveys.article_conversion.%s'
+
+
+def set_conversion_progress(survey_id, progress):
+    cache.set(CONVERSION_PROGRESS_CACHE_KEY % survey_id, progress, None)
+
+
+def get_conversion_progress(survey_id):
+    return cache.get(CONVERSION_PROGRESS_CACHE_KEY % survey_id)
+
+
+def make_submission_article(submission):
+    """Build the unsaved article for a YourWords submission."""
+    body = []
+    for value in submission.get_data().values():
+        body.append({"type": "paragraph", "value": str(value)})
+    return ArticlePage(
+        title='yourwords-entry-%s' % cautious_slugify(submission.pk),
+        slug='yourwords-entry-%s' % cautious_slugify(submission.pk),
+        body=json.dumps(body)
+    )
+
+
+def skip_search_index_updates(instance):
+    """
+    Have the wagtailsearch post_save handler skip ``instance``, which it
+    does for instances without an indexed instance. Other instances of the
+    model are still indexed as they are saved.
+    """
+    instance.get_indexed_instance = lambda: None
+
+
+class SubmissionArticleConverter(object):
+    """
+    Convert survey submissions into unpublished articles under
+    ``index_page``.
+
+    Articles are inserted into the tree ``batch_size`` at a time: the
+    parent is locked once per batch, the tree paths of the new children are
+    computed from its last child and its child count is updated once. The
+    search index is updated in bulk after all the articles are created.
+    """
+    batch_size = 100
+
+    def __init__(self, survey, index_page, batch_size=None):
+        self.survey = survey
+        self.index_page = index_page
+        self.batch_size = batch_size or self.batch_size
+        self.total = 0
+        self.converted = 0
+
+    def convert(self, submissions):
+        submissions = submissions.filter(
+            page=self.survey, article_page__isnull=True).order_by('pk')
+        self.total = submissions.count()
+        self.report_progress()
+
+        article_ids = []
+        last_pk = 0
+        while True:
+            batch = list(submissions.filter(pk__gt=last_pk)[:self.batch_size])
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+
+            article_ids.extend(self.convert_batch(batch))
+            self.converted += len(batch)
+            self.report_progress()
+
+        self.update_search_index(article_ids)
+        self.report_progress(done=True)
+        return article_ids
+
+    def update_search_index(self, article_ids):
+        """Index the new articles in bulk, ``batch_size`` at a time."""
+        backends = list(get_search_backends())
+        for i in range(0, len(article_ids), self.batch_size):
+            articles = list(ArticlePage.objects.filter(
+                pk__in=article_ids[i:i + self.batch_size]))
+            for backend in backends:
+                backend.add_bulk(ArticlePage, articles)
+
+    @transaction.atomic
+    def convert_batch(self, submissions):
+        parent = Page.objects.select_for_update().get(pk=self.index_page.pk)
+        last_child = parent.get_last_child()
+        position = last_child._get_lastpos_in_path() if last_child else 0
+
+        article_ids = []
+        for submission in submissions:
+            position += 1
+            article = make_submission_article(submission)
+            # The articles are indexed in bulk once they are all created
+            skip_search_index_updates(article)
+            article.depth = parent.depth + 1
+            article.path = Page._get_path(parent.path, article.depth, position)
+            article.numchild = 0
+            article.live = False
+            article.has_unpublished_changes = True
+            article.save()
+            article.save_revision()
+
+            submission.article_page = article
+            submission.save(update_fields=['article_page'])
+            article_ids.append(article.pk)
+
+        Page.objects.filter(pk=parent.pk).update(
+            numchild=parent.numchild + len(article_ids))
+        return article_ids
+
+    def report_progress(self, done=False):
+        set_conversion_progress(self.survey.pk, {
+            'total': self.total,
+            'converted': self.converted,
+            'done': done,
+        })
@@ -0,0 +1,101 @@
+import datetime
+
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import (
+    MoloSurveySubmissionAnswer, refresh_segment_memberships_for,
+    submissions_deleted)
+from .utils import normalise_answer
+
+
+DELETION_PROGRESS_CACHE_KEY = 'molo.surveys.submission_deletion.%s'
+
+
+def set_deletion_progress(survey_id, progress):
+    cache.set(DELETION_PROGRESS_CACHE_KEY % survey_id, progress, None)
+
+
+def get_deletion_progress(survey_id):
+    return cache.get(DELETION_PROGRESS_CACHE_KEY % survey_id)
+
+
+def filter_submissions(survey, date_from=None, date_to=None, username=None,
+                       field_name=None, answer=None):
+    """
+    Return the survey's submissions made between the dates, by the user
+    or with the answer to a question.
+    """
+    submissions = survey.get_submission_class().objects.filter(page=survey)
+    if date_from:
+        submissions = submissions.filter(created_at__gte=date_from)
+    if date_to:
+        # created_at is a time, so include the whole last day
+        submissions = submissions.filter(
+            created_at__lt=date_to + datetime.timedelta(days=1))
+    if username:
+        submissions = submissions.filter(user__username=username)
+    if field_name and answer:
+        answers = MoloSurveySubmissionAnswer.objects.filter(
+            page=survey,
+            field_name=field_name,
+            value__in=normalise_answer(answer),
+        )
+        submissions = submissions.filter(
+            pk__in=answers.values('submission_id'))
+    return submissions
+
+
+class SubmissionDeleter(object):
+    """
+    Delete submissions ``batch_size`` at a time, each batch in its own
+    short transaction, so that the submissions table is never locked for
+    long. The answers of the submissions are deleted with them and the
+    materialised segment memberships of their users are refreshed.
+    """
+    batch_size = 500
+
+    def __init__(self, survey, batch_size=None):
+        self.survey = survey
+        self.batch_size = batch_size or self.batch_size
+        self.total = 0
+        self.deleted = 0
+
+    def delete(self, submissions):
+        self.total = submissions.count()
+        self.report_progress()
+
+        submissions = submissions.order_by('pk')
+        while True:
+            batch = list(submissions.values_list(
+                'pk', 'user_id')[:self.batch_size])
+            if not batch:
+                break
+
+            self.delete_batch(
+                [pk for pk, user_id in batch],
+                set(user_id for pk, user_id in batch if user_id))
+            self.deleted += len(batch)
+            self.report_progress()
+
+        self.report_progress(done=True)
+        return self.deleted
+
+    @transaction.atomic
+    def delete_batch(self, submission_ids, user_ids):
+        MoloSurveySubmissionAnswer.objects.filter(
+            submission_id__in=submission_ids).delete()
+        SubmissionClass = self.survey.get_submission_class()
+        deleted, deleted_per_model = SubmissionClass.objects.filter(
+            pk__in=submission_ids).delete()
+        submissions_deleted(
+            self.survey.pk,
+            deleted_per_model.get(SubmissionClass._meta.label, 0))
+        refresh_segment_memberships_for(user_ids)
+
+    def report_progress(self, done=False):
+        set_deletion_progress(self.survey.pk, {
+            'total': self.total,
+            'deleted': self.deleted,
+            'done': done,
+        })
@@ -148,6 +148,61 @@ class CSVGroupCreationForm(forms.ModelForm):
         group.user_set.add(*self.__initial_users)
 
 
+class SegmentUserGroupImportForm(forms.Form):
+    """Add users supplied via CSV file to a segment user group."""
+    csv_file = forms.FileField(
+        label=_('CSV file'),
+        help_text=_('Please attach a CSV file with the first column containing'
+                    ' usernames of users that you want to be added to '
+                    'this group.'))
+    sync = forms.BooleanField(
+        label=_('Replace members'), required=False,
+        help_text=_('Remove the members of the group that are not in the '
+                    'file.'))
+
+
+class SubmissionDeletionForm(forms.Form):
+    """Select the submissions of a survey to delete."""
+    date_from = forms.DateField(label=_('From'), required=False)
+    date_to = forms.DateField(label=_('To'), required=False)
+    username = forms.CharField(label=_('Username'), required=False)
+    field_name = forms.ChoiceField(label=_('Question'), required=False)
+    answer = forms.CharField(label=_('Answer'), required=False)
+    delete_all = forms.BooleanField(
+        label=_('Delete all submissions'), required=False)
+
+    def __init__(self, *args, **kwargs):
+        survey = kwargs.pop('survey')
+        super(SubmissionDeletionForm, self).__init__(*args, **kwargs)
+        self.fields['field_name'].choices = [('', '---------')] + [
+            (field.clean_name, field.label)
+            for field in survey.get_form_fields()
+        ]
+
+    def clean(self):
+        cleaned_data = super(SubmissionDeletionForm, self).clean()
+        if bool(cleaned_data.get('field_name')) != \
+                bool(cleaned_data.get('answer')):
+            raise ValidationError(
+                _('Please select a question and enter an answer.'))
+
+        filters = ['date_from', 'date_to', 'username', 'field_name']
+        if not cleaned_data.get('delete_all') and not any(
+                cleaned_data.get(name) for name in filters):
+            raise ValidationError(
+                _('Please filter the submissions to delete, or choose to '
+                  'delete all of them.'))
+        return cleaned_data
+
+    def get_filters(self):
+        """The filters as strings that can be passed to a task."""
+        return dict(
+            (name, value.isoformat() if name.startswith('date') else value)
+            for name, value in self.cleaned_data.items()
+            if value and name != 'delete_all'
+        )
+
+
 class BaseMoloSurveyForm(WagtailAdminPageForm):
     def clean(self):
         cleaned_data = super(BaseMoloSurveyForm, self).clean()
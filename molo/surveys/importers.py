@@ -0,0 +1,284 @@
+import csv
+import heapq
+import tempfile
+from itertools import chain, islice
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import router, transaction
+from django.db.models.signals import m2m_changed
+
+from .models import SegmentUserGroup
+
+
+IMPORT_SUMMARY_CACHE_KEY = 'molo.surveys.segment_user_group_import.%s'
+
+
+class CSVImportError(Exception):
+    pass
+
+
+def get_sync_max_unknown_ratio():
+    """
+    Largest share of unknown usernames in a file the group is still synced
+    with, so a wrong file doesn't remove most of its members.
+    """
+    return getattr(settings, 'SURVEYS_GROUP_SYNC_MAX_UNKNOWN_RATIO', 0.5)
+
+
+def save_csv_upload(csv_file):
+    """
+    Save an uploaded CSV file to import in the background, outside the
+    public media storage, and return its path. The file is written to
+    SURVEYS_CSV_IMPORT_DIR, or the system's temporary directory, which the
+    Celery workers must share with the web processes.
+    """
+    upload_dir = getattr(settings, 'SURVEYS_CSV_IMPORT_DIR', None)
+    with tempfile.NamedTemporaryFile(
+            suffix='.csv', dir=upload_dir, delete=False) as upload:
+        for chunk in csv_file.chunks():
+            upload.write(chunk)
+    return upload.name
+
+
+def set_import_summary(group, summary):
+    cache.set(IMPORT_SUMMARY_CACHE_KEY % group.pk, summary, None)
+
+
+def get_import_summary(group):
+    return cache.get(IMPORT_SUMMARY_CACHE_KEY % group.pk)
+
+
+def read_usernames(csv_file):
+    """
+    Yield the usernames in the first column of the CSV file one row at a
+    time, skipping the header and empty rows.
+    """
+    try:
+        dialect = csv.Sniffer().sniff(csv_file.read(1024))
+        csv_file.seek(0)
+        has_header = csv.Sniffer().has_header(csv_file.read(1024))
+    except csv.Error:
+        raise CSVImportError('Uploaded file does not appear to be in CSV '
+                             'format.')
+    csv_file.seek(0)
+
+    csv_file_reader = csv.reader(csv_file, dialect)
+    if has_header:
+        next(csv_file_reader, None)
+
+    for row in csv_file_reader:
+        # Skip empty rows and empty username fields
+        if row and row[0].strip():
+            yield row[0].strip()
+
+
+def batched(iterable, batch_size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def sorted_unique(values, chunk_size=100000):
+    """
+    Yield the values sorted and without duplicates, holding at most
+    ``chunk_size`` of them in memory. Sorted chunks are spilled to
+    temporary files and merged.
+    """
+    chunk_files = []
+    try:
+        for chunk in batched(values, chunk_size):
+            chunk_file = tempfile.TemporaryFile(mode='w+')
+            for value in sorted(set(chunk)):
+                chunk_file.write('%d\n' % value)
+            chunk_file.seek(0)
+            chunk_files.append(chunk_file)
+
+        previous = None
+        for value in heapq.merge(*[
+                (int(line) for line in f) for f in chunk_files]):
+            if value != previous:
+                yield value
+                previous = value
+    finally:
+        for chunk_file in chunk_files:
+            chunk_file.close()
+
+
+def diff_sorted(current, wanted):
+    """
+    Compare two sorted iterables of unique values and yield
+    ``(value, True)`` for values to add and ``(value, False)`` for values
+    to remove so that ``current`` matches ``wanted``.
+    """
+    current, wanted = iter(current), iter(wanted)
+    current_value = next(current, None)
+    wanted_value = next(wanted, None)
+
+    while current_value is not None or wanted_value is not None:
+        if wanted_value is None or (
+                current_value is not None and current_value < wanted_value):
+            yield current_value, False
+            current_value = next(current, None)
+        elif current_value is None or wanted_value < current_value:
+            yield wanted_value, True
+            wanted_value = next(wanted, None)
+        else:
+            current_value = next(current, None)
+            wanted_value = next(wanted, None)
+
+
+class SegmentUserGroupImporter(object):
+    """
+    Add the users listed in a CSV file to a segment user group, or sync
+    the group's members with the file.
+
+    Usernames are resolved and memberships changed in batches of
+    ``batch_size``, so only one batch is held in memory at a time.
+    Unknown usernames are counted and the first ``unknown_sample_size`` of
+    them are kept for reporting. m2m_changed is sent once per batch.
+    """
+    batch_size = 1000
+    unknown_sample_size = 100
+
+    def __init__(self, group, batch_size=None):
+        self.group = group
+        self.batch_size = batch_size or self.batch_size
+        self.through = SegmentUserGroup.users.through
+        self.using = router.db_for_write(self.through)
+        self.added = 0
+        self.removed = 0
+        self.resolved = 0
+        self.unknown = 0
+        self.unknown_sample = []
+
+    def import_csv(self, csv_file):
+        return self.import_usernames(read_usernames(csv_file))
+
+    def sync_csv(self, csv_file):
+        return self.sync_usernames(read_usernames(csv_file))
+
+    def import_usernames(self, usernames):
+        for user_ids in self.resolve_user_ids(usernames):
+            self.add_users(set(user_ids))
+        return self
+
+    def sync_usernames(self, usernames):
+        """
+        Make the group's members match the usernames, only adding and
+        removing the differences. Nothing is changed when none of the
+        usernames or too few of them are known.
+        """
+        wanted = sorted_unique(
+            user_id
+            for user_ids in self.resolve_user_ids(usernames)
+            for user_id in user_ids
+        )
+        # All usernames are resolved before the first id is sorted
+        first = next(wanted, None)
+        self.check_resolved()
+        wanted = chain([first], wanted)
+
+        current = self.through.objects.filter(
+            segmentusergroup_id=self.group.pk,
+        ).order_by('user_id').values_list('user_id', flat=True).iterator()
+
+        changes = {True: set(), False: set()}
+        for user_id, add in diff_sorted(current, wanted):
+            changes[add].add(user_id)
+            if len(changes[add]) >= self.batch_size:
+                self.apply_changes(changes[add], add)
+                changes[add] = set()
+
+        self.apply_changes(changes[True], True)
+        self.apply_changes(changes[False], False)
+        return self
+
+    def check_resolved(self):
+        if not self.resolved:
+            raise CSVImportError(
+                'None of the usernames in the file are known, the group '
+                'was not changed.')
+        total = self.resolved + self.unknown
+        if float(self.unknown) / total > get_sync_max_unknown_ratio():
+            raise CSVImportError(
+                '%d of the %d usernames in the file are unknown, the group '
+                'was not changed.' % (self.unknown, total))
+
+    def apply_changes(self, user_ids, add):
+        if add:
+            self.add_users(user_ids)
+        else:
+            self.remove_users(user_ids)
+
+    def resolve_user_ids(self, usernames):
+        """Yield the ids of the users with the usernames, per batch."""
+        for batch in batched(usernames, self.batch_size):
+            users = dict(
+                get_user_model().objects.filter(
+                    username__in=batch,
+                ).values_list('username', 'pk')
+            )
+            self.add_unknown(
+                username for username in batch if username not in users)
+            self.resolved += len(users)
+            yield users.values()
+
+    def add_unknown(self, usernames):
+        for username in usernames:
+            self.unknown += 1
+            if len(self.unknown_sample) < self.unknown_sample_size:
+                self.unknown_sample.append(username)
+
+    def send_m2m_changed(self, action, user_ids):
+        # Memberships are changed in bulk, bypassing the related manager,
+        # so notify receivers once for the whole batch.
+        m2m_changed.send(
+            sender=self.through, instance=self.group, action=action,
+            reverse=False, model=get_user_model(), pk_set=user_ids,
+            using=self.using)
+
+    def add_users(self, user_ids):
+        """Add the users that are not members yet, in one transaction."""
+        with transaction.atomic(using=self.using):
+            existing = set(self.through.objects.filter(
+                segmentusergroup_id=self.group.pk,
+                user_id__in=user_ids,
+            ).values_list('user_id', flat=True))
+            new_user_ids = set(user_ids) - existing
+            if not new_user_ids:
+                return
+
+            self.send_m2m_changed('pre_add', new_user_ids)
+            self.through.objects.bulk_create([
+                self.through(segmentusergroup_id=self.group.pk,
+                             user_id=user_id)
+                for user_id in new_user_ids
+            ])
+            self.send_m2m_changed('post_add', new_user_ids)
+        self.added += len(new_user_ids)
+
+    def remove_users(self, user_ids):
+        if not user_ids:
+            return
+
+        with transaction.atomic(using=self.using):
+            self.send_m2m_changed('pre_remove', user_ids)
+            self.through.objects.filter(
+                segmentusergroup_id=self.group.pk,
+                user_id__in=user_ids,
+            ).delete()
+            self.send_m2m_changed('post_remove', user_ids)
+        self.removed += len(user_ids)
+
+    def get_summary(self):
+        return {
+            'added': self.added,
+            'removed': self.removed,
+            'unknown': self.unknown,
+            'unknown_sample': self.unknown_sample,
+        }
@@ -0,0 +1,70 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models.functions import Length
+
+from molo.surveys.models import MoloSurveySubmission
+from molo.surveys.utils import (
+    COMPRESSED_FORM_DATA_PREFIX,
+    compress_form_data,
+    get_form_data_compression_threshold,
+)
+
+
+class Command(BaseCommand):
+    help = 'Compress the stored form data of large survey submissions.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Number of submissions to compress in one transaction.')
+        parser.add_argument(
+            '--threshold', type=int, default=None,
+            help='Only compress form data longer than this many characters. '
+                 'Defaults to SURVEYS_COMPRESS_FORM_DATA_THRESHOLD.')
+        parser.add_argument(
+            '--dry-run', action='store_true', default=False,
+            help='Report the space that would be saved without saving.')
+
+    def handle(self, *args, **options):
+        threshold = options['threshold']
+        if threshold is None:
+            threshold = get_form_data_compression_threshold() or 1024
+
+        submissions = MoloSurveySubmission.objects.annotate(
+            form_data_length=Length('form_data'),
+        ).filter(
+            form_data_length__gt=threshold,
+        ).exclude(
+            form_data__startswith=COMPRESSED_FORM_DATA_PREFIX,
+        ).order_by('pk')
+
+        compressed_count = size_before = size_after = 0
+        last_pk = 0
+        while True:
+            batch = list(submissions.filter(pk__gt=last_pk).values_list(
+                'pk', 'form_data')[:options['batch_size']])
+            if not batch:
+                break
+            last_pk = batch[-1][0]
+
+            with transaction.atomic():
+                for pk, form_data in batch:
+                    compressed = compress_form_data(form_data, threshold)
+                    if compressed == form_data:
+                        continue
+
+                    compressed_count += 1
+                    size_before += len(form_data)
+                    size_after += len(compressed)
+                    if not options['dry_run']:
+                        MoloSurveySubmission.objects.filter(pk=pk).update(
+                            form_data=compressed)
+
+        saved = size_before - size_after
+        self.stdout.write(
+            '{verb} {count} submission(s): {before} -> {after} characters, '
+            '{saved} saved ({percentage:.1f}%)'.format(
+                verb='Would compress' if options['dry_run'] else 'Compressed',
+                count=compressed_count, before=size_before, after=size_after,
+                saved=saved,
+                percentage=100.0 * saved / size_before if size_before else 0))
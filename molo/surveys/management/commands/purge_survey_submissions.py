@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from molo.surveys.retention import get_archive_dir, purge_expired_submissions
+
+
+class Command(BaseCommand):
+    help = ('Archive and delete survey submissions that are older than '
+            'their survey\'s retention period.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=None,
+            help='Number of submissions to archive and delete at a time.')
+
+    def handle(self, *args, **options):
+        archived = purge_expired_submissions(
+            batch_size=options['batch_size'])
+
+        for survey_id, count in sorted(archived.items()):
+            self.stdout.write(
+                'survey {0}: archived {1} submission(s)'.format(
+                    survey_id, count))
+        self.stdout.write('Archives are in {0}'.format(get_archive_dir()))
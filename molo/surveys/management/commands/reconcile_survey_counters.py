@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from molo.surveys.models import (
+    MoloSurveyPage, SurveyResponseCounter, reconcile_submission_counter)
+
+
+class Command(BaseCommand):
+    help = ('Recount the submissions of every survey and correct the '
+            'submission counters that have drifted.')
+
+    def handle(self, *args, **options):
+        counters = dict(
+            (counter.page_id, counter)
+            for counter in SurveyResponseCounter.objects.all()
+        )
+        surveys = MoloSurveyPage.objects.values_list('pk', flat=True)
+
+        corrected = 0
+        for survey_id in surveys:
+            before = counters.get(survey_id)
+            after = reconcile_submission_counter(survey_id)
+            if before is None or (before.count, before.last_submission_at) \
+                    != (after.count, after.last_submission_at):
+                corrected += 1
+                self.stdout.write(
+                    'survey {0}: {1} -> {2} submission(s)'.format(
+                        survey_id, before.count if before else 0,
+                        after.count))
+
+        self.stdout.write(
+            'Reconciled {0} survey(s), corrected {1}'.format(
+                len(surveys), corrected))
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from molo.surveys.tracing import clear_traces, get_traces, summarise_traces
+
+
+class Command(BaseCommand):
+    help = 'Summarise the traced segment rule evaluations.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--clear', action='store_true', default=False,
+            help='Clear the traces after showing them.')
+
+    def handle(self, *args, **options):
+        summary = summarise_traces(get_traces())
+        if not summary:
+            self.stdout.write('No rule traces recorded.')
+
+        for row in summary:
+            if row['queries'] is None:
+                # Queries are only counted when the connection logs them
+                row['queries'] = '-'
+            else:
+                row['queries'] = '%.1f' % row['queries']
+            self.stdout.write(
+                'segment {segment} {rule}:{rule_id} n={count} '
+                'true={true} queries={queries} p50={p50:.2f}ms '
+                'p95={p95:.2f}ms p99={p99:.2f}ms'.format(**row))
+
+        if options['clear']:
+            clear_traces()
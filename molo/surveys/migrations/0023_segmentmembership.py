@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('wagtail_personalisation', '0015_static_users'),
+        ('surveys', '0022_questionpaginationmixin'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MaterialisedSegment',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('materialised_at', models.DateTimeField(auto_now=True)),
+                ('segment', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='wagtail_personalisation.Segment')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SegmentMembership',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('segment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='wagtail_personalisation.Segment')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='segment_memberships', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='segmentmembership',
+            unique_together=set([('user', 'segment')]),
+        ),
+    ]
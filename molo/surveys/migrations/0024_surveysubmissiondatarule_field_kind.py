@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.utils.encoding import force_text
+from django.utils.text import slugify
+from unidecode import unidecode
+
+
+def get_field_kind(field_type):
+    if field_type is None:
+        return 'missing'
+    if field_type == 'checkboxes':
+        return 'multiple'
+    if field_type == 'checkbox':
+        return 'boolean'
+    return 'text'
+
+
+def set_field_kinds(apps, schema_editor):
+    """Store the kind of the survey field each data rule compares."""
+    SurveySubmissionDataRule = apps.get_model(
+        'surveys', 'SurveySubmissionDataRule')
+    PersonalisableSurveyFormField = apps.get_model(
+        'surveys', 'PersonalisableSurveyFormField')
+
+    field_types_by_survey = {}
+    for rule in SurveySubmissionDataRule.objects.all():
+        if rule.survey_id not in field_types_by_survey:
+            # Form fields are named like AbstractFormField.clean_name
+            field_types_by_survey[rule.survey_id] = dict(
+                (str(slugify(force_text(unidecode(field.label)))),
+                 field.field_type)
+                for field in PersonalisableSurveyFormField.objects.filter(
+                    page_id=rule.survey_id)
+            )
+        field_type = field_types_by_survey[rule.survey_id].get(
+            rule.field_name)
+        SurveySubmissionDataRule.objects.filter(pk=rule.pk).update(
+            field_kind=get_field_kind(field_type))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('surveys', '0023_segmentmembership'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='surveysubmissiondatarule',
+            name='field_kind',
+            field=models.CharField(blank=True, choices=[('text', 'text'), ('multiple', 'multiple choice'), ('boolean', 'boolean'), ('missing', 'missing')], editable=False, max_length=8),
+        ),
+        migrations.RunPython(set_field_kinds, migrations.RunPython.noop),
+    ]
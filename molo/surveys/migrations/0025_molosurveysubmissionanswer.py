@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+from molo.surveys.utils import normalise_answer
+
+
+BATCH_SIZE = 1000
+
+
+def create_submission_answers(apps, schema_editor):
+    MoloSurveySubmission = apps.get_model('surveys', 'MoloSurveySubmission')
+    MoloSurveySubmissionAnswer = apps.get_model(
+        'surveys', 'MoloSurveySubmissionAnswer')
+
+    submissions = MoloSurveySubmission.objects.order_by('pk')
+    last_pk = 0
+    while True:
+        batch = list(submissions.filter(pk__gt=last_pk)[:BATCH_SIZE])
+        if not batch:
+            break
+        last_pk = batch[-1].pk
+
+        MoloSurveySubmissionAnswer.objects.bulk_create([
+            MoloSurveySubmissionAnswer(
+                submission_id=submission.pk, page_id=submission.page_id,
+                user_id=submission.user_id, field_name=field_name,
+                value=value)
+            for submission in batch
+            for field_name, answer in json.loads(submission.form_data).items()
+            for value in normalise_answer(answer)
+        ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('wagtailcore', '0032_add_bulk_delete_page_permission'),
+        ('surveys', '0024_surveysubmissiondatarule_field_kind'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MoloSurveySubmissionAnswer',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('field_name', models.CharField(max_length=255)),
+                ('value', models.TextField()),
+                ('page', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='wagtailcore.Page')),
+                ('submission', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='answers', to='surveys.MoloSurveySubmission')),
+                ('user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='molosurveysubmissionanswer',
+            index_together=set([('page', 'field_name', 'user')]),
+        ),
+        migrations.RunPython(
+            create_submission_answers, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('surveys', '0026_articletagvisit'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='molosurveysubmission',
+            index_together=set([('page', 'created_at', 'id')]),
+        ),
+    ]
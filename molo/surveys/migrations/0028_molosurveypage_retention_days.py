@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('surveys', '0027_molosurveysubmission_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='molosurveypage',
+            name='retention_days',
+            field=models.PositiveIntegerField(blank=True, help_text='Submissions older than this are archived and deleted. Leave empty to keep them forever.', null=True, verbose_name='Keep submissions for (days)'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('surveys', '0028_molosurveypage_retention_days'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='molosurveysubmission',
+            name='idempotency_token',
+            field=models.CharField(editable=False, max_length=32, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Min
+import django.db.models.deletion
+
+
+BATCH_SIZE = 1000
+
+
+def set_single_submission_users(apps, schema_editor):
+    """
+    Mark the first submission of every user of surveys that allow a single
+    submission per user.
+    """
+    MoloSurveyPage = apps.get_model('surveys', 'MoloSurveyPage')
+    MoloSurveySubmission = apps.get_model('surveys', 'MoloSurveySubmission')
+
+    page_ids = MoloSurveyPage.objects.filter(
+        allow_multiple_submissions_per_user=False,
+    ).values_list('pk', flat=True)
+
+    for page_id in page_ids:
+        first_submission_ids = list(
+            MoloSurveySubmission.objects.filter(
+                page_id=page_id, user__isnull=False,
+            ).order_by().values('user_id').annotate(
+                first_id=Min('pk'),
+            ).values_list('first_id', flat=True)
+        )
+        for i in range(0, len(first_submission_ids), BATCH_SIZE):
+            batch = first_submission_ids[i:i + BATCH_SIZE]
+            MoloSurveySubmission.objects.filter(pk__in=batch).update(
+                single_submission_user_id=models.F('user_id'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('surveys', '0029_molosurveysubmission_idempotency_token'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='molosurveysubmission',
+            name='single_submission_user',
+            field=models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RunPython(
+            set_single_submission_users, migrations.RunPython.noop),
+    ]
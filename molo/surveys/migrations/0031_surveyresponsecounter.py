@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wagtailcore', '0032_add_bulk_delete_page_permission'),
+        ('surveys', '0030_molosurveysubmission_single_submission_user'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='molosurveypage',
+            name='response_quota',
+            field=models.PositiveIntegerField(blank=True, help_text='The survey is closed once it has received this many responses. Leave empty for no limit.', null=True, verbose_name='Maximum number of responses'),
+        ),
+        migrations.CreateModel(
+            name='SurveyResponseCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('page', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='wagtailcore.Page')),
+            ],
+        ),
+    ]
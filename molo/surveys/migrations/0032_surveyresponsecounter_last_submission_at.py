@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def count_submissions(apps, schema_editor):
+    """Set the submission counters of every survey that has submissions."""
+    MoloSurveySubmission = apps.get_model('surveys', 'MoloSurveySubmission')
+    SurveyResponseCounter = apps.get_model('surveys', 'SurveyResponseCounter')
+
+    stats = MoloSurveySubmission.objects.values('page_id').annotate(
+        count=Count('pk'), last_submission_at=Max('created_at'),
+    ).order_by()
+    for row in stats:
+        SurveyResponseCounter.objects.update_or_create(
+            page_id=row['page_id'], defaults={
+                'count': row['count'],
+                'last_submission_at': row['last_submission_at'],
+            })
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('surveys', '0031_surveyresponsecounter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='surveyresponsecounter',
+            name='last_submission_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.RunPython(count_submissions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """
+    Add the constraint separately from the data migration of 0030, as
+    PostgreSQL can't alter a table with pending trigger events in the same
+    transaction.
+    """
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('surveys', '0032_surveyresponsecounter_last_submission_at'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='molosurveysubmission',
+            unique_together=set([('page', 'single_submission_user')]),
+        ),
+    ]
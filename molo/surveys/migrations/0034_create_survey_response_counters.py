@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import Count, Max
+
+
+def create_response_counters(apps, schema_editor):
+    """
+    Create the missing submission counters of existing surveys, which were
+    only created by their first submission before.
+    """
+    MoloSurveyPage = apps.get_model('surveys', 'MoloSurveyPage')
+    MoloSurveySubmission = apps.get_model('surveys', 'MoloSurveySubmission')
+    SurveyResponseCounter = apps.get_model('surveys', 'SurveyResponseCounter')
+
+    page_ids = set(MoloSurveyPage.objects.exclude(
+        pk__in=SurveyResponseCounter.objects.values('page_id'),
+    ).values_list('pk', flat=True))
+    stats = dict(
+        (row['page_id'], row)
+        for row in MoloSurveySubmission.objects.filter(
+            page_id__in=page_ids,
+        ).order_by().values('page_id').annotate(
+            count=Count('pk'), last_submission_at=Max('created_at'))
+    )
+    SurveyResponseCounter.objects.bulk_create([
+        SurveyResponseCounter(
+            page_id=page_id,
+            count=stats.get(page_id, {}).get('count', 0),
+            last_submission_at=stats.get(page_id, {}).get(
+                'last_submission_at'),
+        )
+        for page_id in page_ids
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('surveys', '0033_molosurveysubmission_single_submission_unique'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            create_response_counters, migrations.RunPython.noop),
+    ]
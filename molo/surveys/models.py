@@ -5,22 +5,30 @@ from django.core.exceptions import ValidationError
 from django.core.paginator import EmptyPage, PageNotAnInteger
 from django.core.serializers.json import DjangoJSONEncoder
 from django.core.urlresolvers import reverse
-from django.db import models
-from django.db.models import Q
+from django.core.cache import cache
+from django.db import (
+    IntegrityError, connections, models, router, transaction)
+from django.db.models import Count, F, Max, Min, Value
+from django.db.models.functions import Greatest
 from django.db.models.fields import BooleanField, TextField
+from django.db.models.signals import (
+    m2m_changed, post_delete, post_save, pre_delete)
 from django.dispatch import receiver
 from django.http import Http404
 from django.shortcuts import redirect, render
+from django.utils import timezone
 from django.utils.functional import cached_property
 from django.utils.translation import ugettext_lazy as _
 from modelcluster.fields import ParentalKey
 from molo.core.blocks import MarkDownBlock
 from molo.core.models import (
     ArticlePage,
+    ArticlePageTags,
     FooterPage,
     Main,
     PreventDeleteMixin,
     SectionPage,
+    Tag,
     TranslatablePageMixinNotRoutable,
     index_pages_after_copy,
 )
@@ -36,28 +44,54 @@ from wagtail.wagtailadmin.edit_handlers import (
 from wagtail.wagtailcore import blocks
 from wagtail.wagtailcore.fields import StreamField
 from wagtail.wagtailcore.models import Orderable, Page
+from wagtail.wagtailcore.signals import page_published
 from wagtail.wagtailimages.blocks import ImageChooserBlock
 from wagtail.wagtailimages.edit_handlers import ImageChooserPanel
 from wagtail_personalisation.adapters import get_segment_adapter
+from wagtail_personalisation.models import Segment
+from wagtail_personalisation.rules import AbstractBaseRule
 from wagtailsurveys import models as surveys_models
 from wagtailsurveys.models import AbstractFormField
 
+from .adapters import cache_article_tag_ids, invalidate_article_tag_ids
 from .blocks import SkipLogicField, SkipState, SkipLogicStreamPanel
 from .forms import (  # noqa
     MoloSurveyForm,
     PersonalisableMoloSurveyForm,
     SurveysFormBuilder,
 )
+from .results import add_to_survey_results, invalidate_survey_results
 from .rules import (  # noqa
     ArticleTagRule,
     GroupMembershipRule,
     SurveySubmissionDataRule,
     SurveyResponseRule
 )
-from .utils import SkipLogicPaginator
+from .segments import (
+    get_materialisation_batch_size,
+    invalidate_materialised_segment,
+    materialisation_enabled,
+)
+from .utils import (
+    SkipLogicPaginator,
+    compress_form_data,
+    decompress_form_data,
+    get_form_data_compression_threshold,
+    get_idempotency_token,
+    normalise_answer,
+)
 
 
 SKIP = 'NA (Skipped)'
+SUBMISSION_REDIRECT_CACHE_KEY = 'molo.surveys.submission_redirect.%s'
+
+
+class DuplicateSubmission(Exception):
+    """A user submitted a survey that only allows one submission again."""
+
+
+class SurveyQuotaReached(Exception):
+    """A survey has received the maximum number of responses."""
 
 
 # See docs: https://github.com/torchbox/wagtailsurveys
@@ -84,6 +118,103 @@ class SurveysIndexPage(Page, PreventDeleteMixin):
         super(SurveysIndexPage, self).copy(*args, **kwargs)
 
 
+@receiver(page_published, sender=ArticlePage)
+def update_article_tag_ids(sender, instance, **kwargs):
+    # Tags are saved with the article when it is published
+    cache_article_tag_ids(instance)
+
+
+def invalidate_article_tag_ids_on_commit(page_ids):
+    # Also invalidate them after the commit, in case a request cached the
+    # old ids in the meantime.
+    invalidate_article_tag_ids(page_ids)
+    transaction.on_commit(lambda: invalidate_article_tag_ids(page_ids))
+
+
+@receiver(pre_delete, sender=Tag)
+def invalidate_tagged_article_tag_ids(sender, instance, **kwargs):
+    # The articles' links to the tag are cleared after this
+    invalidate_article_tag_ids_on_commit(list(
+        ArticlePageTags.objects.filter(
+            tag=instance).values_list('page_id', flat=True)))
+
+
+@receiver([post_save, post_delete], sender=ArticlePageTags)
+def invalidate_retagged_article_tag_ids(sender, instance, **kwargs):
+    # Tags can be added or removed without publishing the article
+    invalidate_article_tag_ids_on_commit([instance.page_id])
+
+
+class ArticleTagVisit(models.Model):
+    """Latest day (UTC) a user visited a tagged article, per tag."""
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='+',
+    )
+    tag = models.ForeignKey(
+        'core.Tag',
+        on_delete=models.CASCADE,
+        related_name='+',
+    )
+    page = models.ForeignKey(
+        'wagtailcore.Page',
+        on_delete=models.CASCADE,
+        related_name='+',
+    )
+    date = models.DateField()
+
+    class Meta:
+        unique_together = (('user', 'tag', 'page'),)
+
+    @classmethod
+    def record_visits(cls, user_id, visits):
+        """
+        Record visits given as (tag id, page id, date), keeping the latest
+        date of each page, with as few queries as possible.
+        """
+        latest = {}
+        for tag_id, page_id, date in visits:
+            key = (tag_id, page_id)
+            if key not in latest or latest[key] < date:
+                latest[key] = date
+        if not latest:
+            return
+
+        connection = connections[router.db_for_write(cls)]
+        if connection.vendor == 'postgresql':
+            qn = connection.ops.quote_name
+            table = qn(cls._meta.db_table)
+            columns = [qn(column) for column in (
+                'user_id', 'tag_id', 'page_id', 'date')]
+            sql = (
+                'INSERT INTO {table} ({columns}) VALUES {values} '
+                'ON CONFLICT ({user}, {tag}, {page}) '
+                'DO UPDATE SET {date} = GREATEST({table}.{date}, '
+                'EXCLUDED.{date})'
+            ).format(
+                table=table,
+                columns=', '.join(columns),
+                values=', '.join(['(%s, %s, %s, %s)'] * len(latest)),
+                user=columns[0], tag=columns[1], page=columns[2],
+                date=columns[3],
+            )
+            params = []
+            for (tag_id, page_id), date in latest.items():
+                params.extend([user_id, tag_id, page_id, date])
+
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params)
+            return
+
+        for (tag_id, page_id), date in latest.items():
+            visit, created = cls.objects.get_or_create(
+                user_id=user_id, tag_id=tag_id, page_id=page_id,
+                defaults={'date': date})
+            if not created and visit.date < date:
+                cls.objects.filter(pk=visit.pk).update(date=date)
+
+
 @receiver(index_pages_after_copy, sender=Main)
 def create_survey_index_pages(sender, instance, **kwargs):
     if not instance.get_children().filter(
@@ -167,6 +298,18 @@ class MoloSurveyPage(
         verbose_name='Is YourWords Competition',
         help_text='This will display the correct template for yourwords'
     )
+    response_quota = models.PositiveIntegerField(
+        null=True, blank=True,
+        verbose_name='Maximum number of responses',
+        help_text='The survey is closed once it has received this many '
+                  'responses. Leave empty for no limit.'
+    )
+    retention_days = models.PositiveIntegerField(
+        null=True, blank=True,
+        verbose_name='Keep submissions for (days)',
+        help_text='Submissions older than this are archived and deleted. '
+                  'Leave empty to keep them forever.'
+    )
     extra_style_hints = models.TextField(
         default='',
         null=True, blank=True,
@@ -193,6 +336,8 @@ class MoloSurveyPage(
             FieldPanel('multi_step'),
             FieldPanel('display_survey_directly'),
             FieldPanel('your_words_competition'),
+            FieldPanel('response_quota'),
+            FieldPanel('retention_days'),
         ], heading='Survey Settings'),
         MultiFieldPanel(
             [FieldRowPanel(
@@ -225,17 +370,117 @@ class MoloSurveyPage(
 
     def process_form_submission(self, form):
         user = form.user if not form.user.is_anonymous() else None
+        idempotency_token = getattr(form, 'idempotency_token', None)
+        # The unique (page, single_submission_user) constraint only applies
+        # to surveys that allow a single submission per user.
+        single_submission_user = (
+            None if self.allow_multiple_submissions_per_user else user)
+        SubmissionClass = self.get_submission_class()
+        form_data = json.dumps(form.cleaned_data, cls=DjangoJSONEncoder)
 
-        self.get_submission_class().objects.create(
-            form_data=json.dumps(form.cleaned_data, cls=DjangoJSONEncoder),
-            page=self, user=user
+        try:
+            with transaction.atomic():
+                SubmissionClass.objects.create(
+                    form_data=compress_form_data(
+                        form_data, get_form_data_compression_threshold()),
+                    page=self, user=user,
+                    single_submission_user=single_submission_user,
+                    idempotency_token=idempotency_token,
+                )
+                # Saving the submission incremented the survey's counter
+                # row, which stays locked until the transaction ends, so
+                # concurrent submissions can never go over the quota.
+                if self.response_quota is not None and \
+                        self.get_response_counter().filter(
+                            count__gt=self.response_quota).exists():
+                    raise SurveyQuotaReached()
+        except IntegrityError:
+            # A concurrent retry of the same form was saved first
+            if idempotency_token is not None and \
+                    SubmissionClass.objects.filter(
+                        idempotency_token=idempotency_token).exists():
+                return
+            if single_submission_user is not None and \
+                    SubmissionClass.objects.filter(
+                        page=self,
+                        single_submission_user=single_submission_user,
+                    ).exists():
+                raise DuplicateSubmission()
+            raise
+        add_to_survey_results(self.pk, json.loads(form_data))
+
+    def set_single_submission_users(self, batch_size=1000):
+        """
+        Mark the first submission of every user without a marked one, so
+        submissions made while the survey allowed several per user count
+        towards the single submission constraint.
+        """
+        submissions = self.get_submission_class().objects.filter(page=self)
+        marked_user_ids = submissions.filter(
+            single_submission_user__isnull=False,
+        ).values('single_submission_user')
+        first_submission_ids = list(
+            # Without the default ordering, which would be grouped by too
+            submissions.filter(user__isnull=False).exclude(
+                user__in=marked_user_ids,
+            ).order_by().values('user_id').annotate(
+                first_id=Min('pk'),
+            ).values_list('first_id', flat=True)
         )
+        for i in range(0, len(first_submission_ids), batch_size):
+            submissions.filter(
+                pk__in=first_submission_ids[i:i + batch_size],
+            ).update(single_submission_user_id=F('user_id'))
+
+    def get_response_counter(self):
+        return SurveyResponseCounter.objects.filter(page_id=self.pk)
 
-    def has_user_submitted_survey(self, request, survey_page_id):
+    def is_quota_reached(self):
+        return self.response_quota is not None and \
+            self.get_response_counter().filter(
+                count__gte=self.response_quota).exists()
+
+    def render_closed(self, request):
+        context = self.get_context(request)
+        context['quota_reached'] = True
+        return render(request, self.template, context)
+
+    def get_retried_submission_redirect(self, request):
+        """
+        Return the redirect of an earlier submission of the same form when
+        a POST is retried, so that it is not validated and saved again.
+        """
+        token = get_idempotency_token(request)
+        if token is None:
+            return None
+
+        url = cache.get(SUBMISSION_REDIRECT_CACHE_KEY % token)
+        if url is None and self.get_submission_class().objects.filter(
+                idempotency_token=token).exists():
+            url = reverse('molo.surveys:success', args=(self.slug, ))
+        return redirect(url) if url else None
+
+    def submitted(self, request, form, response):
+        """Save the submission and remember the redirect that follows it."""
+        token = get_idempotency_token(request)
+        form.idempotency_token = token
+        try:
+            self.process_form_submission(form)
+        except DuplicateSubmission:
+            return render(request, self.template, self.get_context(request))
+        except SurveyQuotaReached:
+            return self.render_closed(request)
+        if token is not None:
+            cache.set(SUBMISSION_REDIRECT_CACHE_KEY % token, response.url,
+                      60 * 60)
+        return response
+
+    def has_user_submitted_survey(self, request, survey_page_id,
+                                  check_database=True):
         if 'completed_surveys' not in request.session:
             request.session['completed_surveys'] = []
 
-        if request.user.pk is not None \
+        if check_database and request.user.pk is not None \
             and self.get_submission_class().objects.filter(
                 page=self, user__pk=request.user.pk
             ).exists() \
@@ -332,10 +577,11 @@ class MoloSurveyPage(
                             if question.clean_name not in data:
                                 form.cleaned_data[question.clean_name] = SKIP
 
-                        self.process_form_submission(form)
+                        response = self.submitted(
+                            request, form, prev_step.success(self.slug))
                         del request.session[session_key_data]
 
-                        return prev_step.success(self.slug)
+                        return response
 
             else:
                 # If data for step is invalid
@@ -366,8 +612,20 @@ class MoloSurveyPage(
         )
 
     def serve(self, request, *args, **kwargs):
+        if request.method == 'POST':
+            retried_redirect = self.get_retried_submission_redirect(request)
+            if retried_redirect is not None:
+                return retried_redirect
+
+        if self.is_quota_reached():
+            return self.render_closed(request)
+
+        # Posted submissions of logged-in users are limited by a database
+        # constraint when they are saved, so only the session is checked.
         if not self.allow_multiple_submissions_per_user \
-                and self.has_user_submitted_survey(request, self.id):
+                and self.has_user_submitted_survey(
+                    request, self.id,
+                    check_database=request.method != 'POST'):
             return render(request, self.template, self.get_context(request))
 
         if self.has_page_breaks or self.multi_step:
@@ -378,15 +636,29 @@ class MoloSurveyPage(
 
             if form.is_valid():
                 self.set_survey_as_submitted_for_session(request)
-                self.process_form_submission(form)
 
                 # render the landing_page
-                return redirect(
-                    reverse('molo.surveys:success', args=(self.slug, )))
+                return self.submitted(request, form, redirect(
+                    reverse('molo.surveys:success', args=(self.slug, ))))
 
         return super(MoloSurveyPage, self).serve(request, *args, **kwargs)
 
 
+class SurveyResponseCounter(models.Model):
+    """
+    Denormalised number of submissions of a survey and the time of the
+    latest one. They are kept out of the page table so that publishing a
+    revision of the survey can not overwrite them.
+    """
+    page = models.OneToOneField(
+        'wagtailcore.Page',
+        on_delete=models.CASCADE,
+        related_name='+',
+    )
+    count = models.PositiveIntegerField(default=0)
+    last_submission_at = models.DateTimeField(null=True)
+
+
 class SurveyTermsConditions(Orderable):
     page = ParentalKey(MoloSurveyPage, related_name='terms_and_conditions')
     terms_and_conditions = models.ForeignKey(
@@ -495,6 +767,16 @@ class MoloSurveyFormField(SkipLogicMixin, AdminLabelMixin,
 surveys_models.AbstractFormField.panels[4] = SkipLogicStreamPanel('skip_logic')
 
 
+class MoloSurveySubmissionManager(models.Manager):
+    """
+    Fetch the user with the submissions, as ``get_data()`` reads their
+    username for every row of the wagtailsurveys listing and CSV export.
+    """
+    def get_queryset(self):
+        return super(MoloSurveySubmissionManager, self).get_queryset(
+        ).select_related('user')
+
+
 class MoloSurveySubmission(surveys_models.AbstractFormSubmission):
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL, on_delete=models.CASCADE, null=True
@@ -507,14 +789,145 @@ class MoloSurveySubmission(surveys_models.AbstractFormSubmission):
         related_name='+',
         help_text='Page to which the entry was converted to'
     )
+    # Set to the user for surveys that allow a single submission per user
+    single_submission_user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, null=True,
+        editable=False, related_name='+'
+    )
+    idempotency_token = models.CharField(
+        max_length=32, null=True, unique=True, editable=False)
+
+    objects = MoloSurveySubmissionManager()
+
+    class Meta(surveys_models.AbstractFormSubmission.Meta):
+        index_together = [['page', 'created_at', 'id']]
+        unique_together = [['page', 'single_submission_user']]
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            result = super(MoloSurveySubmission, self).delete(*args, **kwargs)
+            submissions_deleted(self.page_id, 1)
+        return result
+
+    def get_form_data(self):
+        """The submitted answers, decompressing the stored form data."""
+        return json.loads(decompress_form_data(self.form_data))
 
     def get_data(self):
-        form_data = super(MoloSurveySubmission, self).get_data()
+        form_data = self.get_form_data()
         form_data.update({
+            'created_at': self.created_at,
             'username': self.user.username if self.user else 'Anonymous',
         })
         return form_data
 
+    def get_answers(self):
+        """Build the normalised answer rows for this submission."""
+        return [
+            MoloSurveySubmissionAnswer(
+                submission=self, page_id=self.page_id, user_id=self.user_id,
+                field_name=field_name, value=value)
+            for field_name, answer in self.get_form_data().items()
+            for value in normalise_answer(answer)
+        ]
+
+
+class MoloSurveySubmissionAnswer(models.Model):
+    """
+    One row per answer (or selected option) of a submission, normalised
+    so rules can compare responses in the database.
+    """
+    submission = models.ForeignKey(
+        MoloSurveySubmission,
+        on_delete=models.CASCADE,
+        related_name='answers',
+    )
+    page = models.ForeignKey(
+        'wagtailcore.Page',
+        on_delete=models.CASCADE,
+        related_name='+',
+    )
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        null=True,
+        related_name='+',
+    )
+    field_name = models.CharField(max_length=255)
+    value = models.TextField()
+
+    class Meta:
+        index_together = (('page', 'field_name', 'user'),)
+
+
+def reconcile_submission_counter(page_id):
+    """Recount a survey's submissions from the submissions table."""
+    stats = MoloSurveySubmission.objects.filter(page_id=page_id).aggregate(
+        count=Count('pk'), last_submission_at=Max('created_at'))
+    counter, created = SurveyResponseCounter.objects.update_or_create(
+        page_id=page_id, defaults=stats)
+    return counter
+
+
+def increment_submission_counter(page_id, created_at):
+    return SurveyResponseCounter.objects.filter(page_id=page_id).update(
+        count=F('count') + 1, last_submission_at=created_at)
+
+
+def submission_created(page_id, created_at):
+    # Surveys created without signals get an empty counter, which
+    # concurrent first submissions all increment, rather than a recount
+    # that would miss their uncommitted submissions.
+    if not increment_submission_counter(page_id, created_at):
+        SurveyResponseCounter.objects.get_or_create(page_id=page_id)
+        increment_submission_counter(page_id, created_at)
+
+
+def submissions_deleted(page_id, count):
+    last_submission_at = MoloSurveySubmission.objects.filter(
+        page_id=page_id).aggregate(latest=Max('created_at'))['latest']
+    if not SurveyResponseCounter.objects.filter(page_id=page_id).update(
+            count=Greatest(F('count') - count, Value(0)),
+            last_submission_at=last_submission_at):
+        reconcile_submission_counter(page_id)
+    invalidate_survey_results(page_id)
+
+
+@receiver(post_save)
+def create_submission_counter(sender, instance, created, raw=False,
+                              **kwargs):
+    # Created with the survey, so saving a submission only has to
+    # increment it
+    if created and not raw and isinstance(instance, MoloSurveyPage):
+        SurveyResponseCounter.objects.get_or_create(page_id=instance.pk)
+
+
+@receiver(post_save, sender=MoloSurveySubmission)
+def count_submission(sender, instance, created, **kwargs):
+    if created:
+        submission_created(instance.page_id, instance.created_at)
+
+
+@receiver(page_published)
+def invalidate_results_of_published_survey(sender, instance, **kwargs):
+    # The results are counted by question label, which may have changed
+    if isinstance(instance, MoloSurveyPage):
+        invalidate_survey_results(instance.pk)
+
+
+@receiver(page_published)
+def mark_single_submission_users(sender, instance, **kwargs):
+    # Surveys switched to a single submission per user
+    if isinstance(instance, MoloSurveyPage) and \
+            not instance.allow_multiple_submissions_per_user:
+        instance.set_single_submission_users()
+
+
+@receiver(post_save, sender=MoloSurveySubmission)
+def create_submission_answers(sender, instance, created, **kwargs):
+    if created:
+        MoloSurveySubmissionAnswer.objects.bulk_create(instance.get_answers())
+
 
 # Personalised Surveys
 def get_personalisable_survey_content_panels():
@@ -559,18 +972,31 @@ class PersonalisableSurvey(MoloSurveyPage):
         return (hasattr(self, 'request') and
                 not getattr(self.request, 'is_preview', False))
 
+    @cached_property
+    def all_form_fields(self):
+        """All the survey's form fields, loaded once per page instance."""
+        return list(self.personalisable_survey_form_fields.all())
+
+    def get_user_segment_ids(self):
+        """Ids of the user's segments, looked up once per request."""
+        if not hasattr(self.request, '_survey_segment_ids'):
+            self.request._survey_segment_ids = frozenset(
+                s.id for s in get_segment_adapter(self.request).get_segments()
+            )
+        return self.request._survey_segment_ids
+
     def get_form_fields(self):
         """Get form fields for particular segments."""
         # Get only segmented form fields if serve() has been called
         # (because the page is being seen by user on the front-end)
         if self.is_front_end_request():
-            user_segments_ids = [
-                s.id for s in get_segment_adapter(self.request).get_segments()
-            ]
+            user_segments_ids = self.get_user_segment_ids()
 
-            return self.personalisable_survey_form_fields.filter(
-                Q(segment=None) | Q(segment_id__in=user_segments_ids)
-            )
+            return [
+                field for field in self.all_form_fields
+                if field.segment_id is None or
+                field.segment_id in user_segments_ids
+            ]
 
         # Return all form fields if there's no request passed
         # (used on the admin site so serve() will not be called).
@@ -613,6 +1039,16 @@ class PersonalisableSurvey(MoloSurveyPage):
             request, *args, **kwargs)
 
 
+@receiver(page_published, sender=PersonalisableSurvey)
+def update_survey_submission_rules(sender, instance, **kwargs):
+    """Keep the stored field kinds of rules in line with the survey."""
+    form_fields = instance.get_form().fields
+    for rule in SurveySubmissionDataRule.objects.filter(survey=instance):
+        rule.update_field_kind(form_fields)
+        SurveySubmissionDataRule.objects.filter(pk=rule.pk).update(
+            field_kind=rule.field_kind)
+
+
 class PersonalisableSurveyFormField(SkipLogicMixin, AdminLabelMixin,
                                     QuestionPaginationMixin,
                                     AbstractFormField):
@@ -646,3 +1082,102 @@ class SegmentUserGroup(models.Model):
 
     def __str__(self):
         return self.name
+
+
+class SegmentMembership(models.Model):
+    """
+    Membership of a user in a segment, materialised in the background
+    for segments built only from rules that depend on stored user data.
+    """
+    segment = models.ForeignKey(
+        'wagtail_personalisation.Segment',
+        on_delete=models.CASCADE,
+        related_name='+',
+    )
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='segment_memberships',
+    )
+
+    class Meta:
+        unique_together = (('user', 'segment'),)
+
+
+class MaterialisedSegment(models.Model):
+    """Marks a segment whose memberships are fully materialised."""
+    segment = models.OneToOneField(
+        'wagtail_personalisation.Segment',
+        on_delete=models.CASCADE,
+        related_name='+',
+    )
+    materialised_at = models.DateTimeField(auto_now=True)
+
+
+def schedule_segment_materialisation(segment_id):
+    # The segment's rules may have changed, so stop trusting the stored
+    # memberships until they have been evaluated again.
+    invalidate_materialised_segment(segment_id)
+
+    if materialisation_enabled():
+        from .tasks import materialise_segment_memberships
+
+        requested_at = timezone.now().isoformat()
+        transaction.on_commit(
+            lambda: materialise_segment_memberships.delay(
+                segment_id, requested_at))
+
+
+@receiver(post_save, sender=Segment)
+def rematerialise_segment(sender, instance, **kwargs):
+    schedule_segment_materialisation(instance.pk)
+
+
+@receiver([post_save, post_delete])
+def rematerialise_segment_of_rule(sender, instance, **kwargs):
+    # The rules of a segment are saved after the segment itself, so it is
+    # evaluated again after each of them. The task skips evaluations that
+    # a later one already covered.
+    if isinstance(instance, AbstractBaseRule) and instance.segment_id:
+        schedule_segment_materialisation(instance.segment_id)
+
+
+def refresh_segment_memberships_for(user_ids):
+    if not materialisation_enabled():
+        return
+
+    from .tasks import refresh_users_segment_memberships
+
+    user_ids = list(user_ids)
+    batch_size = get_materialisation_batch_size()
+    for i in range(0, len(user_ids), batch_size):
+        batch = user_ids[i:i + batch_size]
+        transaction.on_commit(
+            lambda batch=batch:
+                refresh_users_segment_memberships.delay(batch))
+
+
+@receiver(post_save, sender=MoloSurveySubmission)
+def refresh_memberships_after_submission(sender, instance, created,
+                                         **kwargs):
+    if created and instance.user_id:
+        refresh_segment_memberships_for([instance.user_id])
+
+
+@receiver(m2m_changed, sender=SegmentUserGroup.users.through)
+def refresh_memberships_after_group_change(sender, instance, action,
+                                           reverse, pk_set, **kwargs):
+    if reverse:
+        # Changed through ``user.segment_groups``
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            refresh_segment_memberships_for([instance.pk])
+        return
+
+    if action == 'pre_clear':
+        instance._cleared_user_ids = list(
+            instance.users.values_list('pk', flat=True))
+    elif action == 'post_clear':
+        refresh_segment_memberships_for(
+            getattr(instance, '_cleared_user_ids', []))
+    elif action in ('post_add', 'post_remove'):
+        refresh_segment_memberships_for(pk_set)
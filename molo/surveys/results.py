@@ -0,0 +1,333 @@
+from __future__ import unicode_literals
+
+import hashlib
+import json
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+# Generation of a survey's cached results, and its fields. The counters of
+# a generation are kept under keys prefixed with RESULTS_COUNTERS_CACHE_KEY.
+RESULTS_CACHE_KEY = 'molo.surveys.survey_results.%s'
+# The last generation, still read while the results are counted again
+STALE_RESULTS_CACHE_KEY = 'molo.surveys.survey_results.%s.stale'
+RESULTS_COUNTERS_CACHE_KEY = 'molo.surveys.survey_results.%s.%s'
+RESULTS_LOCK_CACHE_KEY = 'molo.surveys.results_lock.%s'
+
+
+# Answers to a question beyond the most distinct ones counted separately
+OTHER_ANSWERS = 'Other'
+OTHER_SLOT = 'other'
+
+
+def get_max_distinct_answers():
+    """Number of distinct answers counted separately for each question."""
+    return getattr(settings, 'SURVEYS_RESULTS_MAX_DISTINCT_ANSWERS', 100)
+
+
+def live_results_enabled():
+    """Whether results pages poll for new results, off by default."""
+    return getattr(settings, 'SURVEYS_LIVE_RESULTS', False)
+
+
+def get_results_poll_interval():
+    """
+    Seconds between polls for new results, which is also how long their
+    responses are cached for.
+    """
+    return getattr(settings, 'SURVEYS_RESULTS_POLL_INTERVAL', 5)
+
+
+def get_results_cache_timeout():
+    """
+    Seconds the cached results are kept before they are tallied again, so
+    a submission missed while they were tallied is counted eventually.
+    """
+    return getattr(settings, 'SURVEYS_RESULTS_CACHE_TIMEOUT', 300)
+
+
+def get_counters_cache_timeout():
+    # Counters outlive their generation, so it can still be read as the
+    # stale results while the next one is counted
+    return get_results_cache_timeout() * 2
+
+
+def count_answer(question_stats, answer, max_answers):
+    if answer not in question_stats and len(question_stats) >= max_answers:
+        answer = OTHER_ANSWERS
+    question_stats[answer] = question_stats.get(answer, 0) + 1
+
+
+def count_answers(tally, data, max_answers=None):
+    """
+    Add the answers of one submission to a survey's ``tally``. Every
+    option selected in a checkboxes question is counted on its own, and
+    ``respondents`` counts the submissions that answered each question.
+    """
+    if max_answers is None:
+        max_answers = get_max_distinct_answers()
+    results = tally['results']
+    respondents = tally['respondents']
+    for name, label in tally['fields']:
+        answer = data.get(name)
+        if answer is None:
+            # Something wrong with data.
+            # Probably you have changed questions
+            # and now we are receiving answers for old questions.
+            # Just skip them.
+            continue
+
+        question_stats = results.setdefault(label, {})
+        if type(answer) is list:
+            # answer is a list if the field type is 'Checkboxes'
+            for option in answer:
+                count_answer(question_stats, option, max_answers)
+        else:
+            count_answer(question_stats, answer, max_answers)
+        respondents[label] = respondents.get(label, 0) + 1
+
+
+def tally_survey_results(survey, batch_size=1000):
+    """
+    Count the answers to each question of a survey in one pass over its
+    submissions, fetching ``batch_size`` of them at a time.
+    """
+    tally = {
+        'fields': [
+            (field.clean_name, field.label)
+            for field in survey.get_form_fields()
+        ],
+        'results': {},
+        'respondents': {},
+    }
+    max_answers = get_max_distinct_answers()
+    submissions = survey.get_submission_class().objects.filter(
+        page=survey).select_related(None).only(
+            'pk', 'form_data').order_by('pk')
+    last_pk = 0
+    while True:
+        batch = list(submissions.filter(pk__gt=last_pk)[:batch_size])
+        if not batch:
+            break
+        last_pk = batch[-1].pk
+        for submission in batch:
+            count_answers(tally, submission.get_form_data(), max_answers)
+    return tally
+
+
+class ResultCounters(object):
+    """
+    The cached answer counts of one generation of a survey's results, one
+    key per question and answer so submissions only ever increment them.
+
+    Answers get a numbered slot per question the first time they are
+    counted. Once a question has ``max_answers`` slots, new answers are
+    counted under "Other".
+    """
+    def __init__(self, survey_id, generation, fields):
+        self.prefix = RESULTS_COUNTERS_CACHE_KEY % (survey_id, generation)
+        self.generation = generation
+        self.fields = fields
+        self.timeout = get_counters_cache_timeout()
+
+    def key(self, *parts):
+        return '.'.join([self.prefix] + [str(part) for part in parts])
+
+    def slot_key(self, question, answer):
+        answer_hash = hashlib.md5(
+            json.dumps(answer, sort_keys=True).encode('utf-8')).hexdigest()
+        return self.key(question, 'slot', answer_hash)
+
+    def incr(self, key):
+        try:
+            return cache.incr(key)
+        except ValueError:
+            cache.add(key, 0, self.timeout)
+            return cache.incr(key)
+
+    def store(self, tally):
+        """Set the counters to the counts of a tally."""
+        values = {self.key('version'): 0}
+        for question, (name, label) in enumerate(self.fields):
+            answers = tally['results'].get(label, {})
+            values[self.key(question, 'respondents')] = \
+                tally['respondents'].get(label, 0)
+            values[self.key(question, 'count', OTHER_SLOT)] = \
+                answers.get(OTHER_ANSWERS, 0)
+            slot = 0
+            for answer, count in answers.items():
+                if answer == OTHER_ANSWERS:
+                    continue
+                slot += 1
+                values[self.slot_key(question, answer)] = slot
+                values[self.key(question, 'answer', slot)] = answer
+                values[self.key(question, 'count', slot)] = count
+            values[self.key(question, 'answers')] = slot
+        cache.set_many(values, self.timeout)
+
+    def get_slot(self, question, answer, max_answers):
+        slot_key = self.slot_key(question, answer)
+        slot = cache.get(slot_key)
+        if slot is not None:
+            return slot
+
+        slot = self.incr(self.key(question, 'answers'))
+        if slot > max_answers:
+            slot = OTHER_SLOT
+        if cache.add(slot_key, slot, self.timeout):
+            if slot != OTHER_SLOT:
+                cache.set(self.key(question, 'answer', slot), answer,
+                          self.timeout)
+            return slot
+        # Claimed by a concurrent submission, the new slot stays unnamed
+        return cache.get(slot_key, OTHER_SLOT)
+
+    def add(self, data):
+        """Count the answers of a new submission."""
+        max_answers = get_max_distinct_answers()
+        for question, (name, label) in enumerate(self.fields):
+            answer = data.get(name)
+            if answer is None:
+                continue
+            # Every option selected in a checkboxes question is counted
+            options = answer if type(answer) is list else [answer]
+            for option in options:
+                slot = self.get_slot(question, option, max_answers)
+                self.incr(self.key(question, 'count', slot))
+            self.incr(self.key(question, 'respondents'))
+        self.incr(self.key('version'))
+
+    def read(self):
+        """The counts as a tally, with two cache round trips."""
+        keys = [self.key('version')]
+        for question in range(len(self.fields)):
+            keys.extend([
+                self.key(question, 'answers'),
+                self.key(question, 'respondents'),
+                self.key(question, 'count', OTHER_SLOT),
+            ])
+        values = cache.get_many(keys)
+
+        slot_keys = []
+        for question in range(len(self.fields)):
+            slots = min(values.get(self.key(question, 'answers')) or 0,
+                        get_max_distinct_answers())
+            for slot in range(1, slots + 1):
+                slot_keys.extend([
+                    self.key(question, 'answer', slot),
+                    self.key(question, 'count', slot),
+                ])
+        values.update(cache.get_many(slot_keys))
+
+        tally = {
+            'version': '%s.%s' % (
+                self.generation, values.get(self.key('version'), 0)),
+            'fields': self.fields,
+            'results': {},
+            'respondents': {},
+        }
+        for question, (name, label) in enumerate(self.fields):
+            respondents = values.get(self.key(question, 'respondents'))
+            if not respondents:
+                continue
+            tally['respondents'][label] = respondents
+            answers = tally['results'].setdefault(label, {})
+            slots = values.get(self.key(question, 'answers')) or 0
+            for slot in range(1, slots + 1):
+                answer_key = self.key(question, 'answer', slot)
+                count = values.get(self.key(question, 'count', slot))
+                if answer_key in values and count:
+                    answers[values[answer_key]] = count
+            other = values.get(self.key(question, 'count', OTHER_SLOT))
+            if other:
+                answers[OTHER_ANSWERS] = answers.get(OTHER_ANSWERS, 0) + other
+        return tally
+
+
+def get_result_counters(survey_id, key=RESULTS_CACHE_KEY):
+    meta = cache.get(key % survey_id)
+    if meta is None:
+        return None
+    return ResultCounters(survey_id, meta['generation'], meta['fields'])
+
+
+def rebuild_survey_results(survey):
+    """Tally a survey's results from the database into new counters."""
+    tally = tally_survey_results(survey)
+    counters = ResultCounters(survey.pk, uuid.uuid4().hex, tally['fields'])
+    counters.store(tally)
+    meta = {'generation': counters.generation, 'fields': counters.fields}
+    cache.set(STALE_RESULTS_CACHE_KEY % survey.pk, meta,
+              get_counters_cache_timeout())
+    cache.set(RESULTS_CACHE_KEY % survey.pk, meta,
+              get_results_cache_timeout())
+    return counters
+
+
+def get_survey_results(survey, wait=5):
+    """
+    The answer counts of a survey, with a version that changes whenever
+    they do. They are tallied from the database by one process at a time
+    and then kept up to date in the cache as submissions are saved, until
+    they expire. Meanwhile the previous counts are served, or, when there
+    are none, the new ones are waited for up to ``wait`` seconds.
+    """
+    counters = get_result_counters(survey.pk)
+    if counters is not None:
+        return counters.read()
+
+    lock_key = RESULTS_LOCK_CACHE_KEY % survey.pk
+    if cache.add(lock_key, True, 60):
+        try:
+            return rebuild_survey_results(survey).read()
+        finally:
+            cache.delete(lock_key)
+
+    counters = get_result_counters(survey.pk, STALE_RESULTS_CACHE_KEY)
+    deadline = time.time() + wait
+    while counters is None and time.time() < deadline:
+        time.sleep(0.1)
+        counters = get_result_counters(survey.pk)
+    if counters is None:
+        return {'version': '', 'fields': [], 'results': {},
+                'respondents': {}}
+    return counters.read()
+
+
+def add_to_survey_results(survey_id, data):
+    """Count a new submission in the cached results of its survey."""
+    counters = get_result_counters(survey_id)
+    if counters is not None:
+        counters.add(data)
+
+
+def invalidate_survey_results(survey_id):
+    cache.delete_many([
+        RESULTS_CACHE_KEY % survey_id,
+        STALE_RESULTS_CACHE_KEY % survey_id,
+    ])
+
+
+def as_percentages(results, respondents):
+    """
+    Answer counts as percentages of the submissions that answered each
+    question, so the options of a checkboxes question can add up to more
+    than 100%.
+    """
+    percentages = {}
+    for question, answers in results.items():
+        total = respondents.get(question) or sum(answers.values())
+        percentages[question] = dict(
+            (answer, (count * 100) / total)
+            for answer, count in answers.items()
+        )
+    return percentages
+
+
+def get_results_for_display(survey, tally):
+    if survey.show_results_as_percentage:
+        return as_percentages(tally['results'], tally['respondents'])
+    return tally['results']
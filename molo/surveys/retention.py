@@ -0,0 +1,151 @@
+import datetime
+import gzip
+import json
+import os
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ImproperlyConfigured
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .deletion import SubmissionDeleter
+from .models import MoloSurveyPage, MoloSurveySubmission
+
+
+def is_within(path, directory):
+    path, directory = os.path.realpath(path), os.path.realpath(directory)
+    return path == directory or path.startswith(directory + os.sep)
+
+
+def get_archive_dir():
+    """
+    The directory archives are written to. Archives hold every answer of
+    the submissions, so it must be set explicitly and must not be served
+    publicly from MEDIA_ROOT or STATIC_ROOT.
+    """
+    archive_dir = getattr(settings, 'SURVEYS_ARCHIVE_DIR', None)
+    if not archive_dir:
+        raise ImproperlyConfigured(
+            'Set SURVEYS_ARCHIVE_DIR to a private directory to archive '
+            'survey submissions.')
+    for name in ('MEDIA_ROOT', 'STATIC_ROOT'):
+        public_dir = getattr(settings, name, None)
+        if public_dir and is_within(archive_dir, public_dir):
+            raise ImproperlyConfigured(
+                'SURVEYS_ARCHIVE_DIR must not be inside %s, where the '
+                'archives would be public.' % name)
+    return archive_dir
+
+
+def get_archive_path(survey_id, created_at):
+    """Archives are kept in one file per survey and month."""
+    return os.path.join(
+        get_archive_dir(), str(survey_id),
+        '%s.ndjson.gz' % created_at.strftime('%Y-%m'))
+
+
+def serialise_submission(submission):
+    return json.dumps({
+        'id': submission.pk,
+        'page_id': submission.page_id,
+        'user_id': submission.user_id,
+        'username': submission.user.username if submission.user else None,
+        'created_at': submission.created_at,
+        'form_data': submission.get_form_data(),
+    }, cls=DjangoJSONEncoder)
+
+
+def read_archived_submissions(path):
+    """
+    Yield the submissions in an archive as unsaved MoloSurveySubmission
+    instances, so ``get_data`` and the CSV export work on them as usual.
+    """
+    with gzip.open(path, 'rb') as archive:
+        for line in archive:
+            data = json.loads(line.decode('utf-8'))
+            submission = MoloSurveySubmission(
+                pk=data['id'],
+                page_id=data['page_id'],
+                created_at=parse_datetime(data['created_at']),
+                form_data=json.dumps(data['form_data']),
+            )
+            if data['user_id']:
+                submission.user = get_user_model()(
+                    pk=data['user_id'], username=data['username'])
+            yield submission
+
+
+class SubmissionArchiver(object):
+    """
+    Archive and delete the submissions of a survey that are older than its
+    retention period.
+
+    Submissions are processed in id order, ``batch_size`` at a time: each
+    batch is appended to the gzipped NDJSON file of its survey and month
+    (as a new gzip member) before it is deleted.
+    """
+    batch_size = 1000
+
+    def __init__(self, survey, batch_size=None, now=None):
+        self.survey = survey
+        self.batch_size = batch_size or self.batch_size
+        self.cutoff = (now or timezone.now()) - datetime.timedelta(
+            days=survey.retention_days)
+        self.deleter = SubmissionDeleter(survey)
+        self.archived = 0
+
+    def get_expired_submissions(self):
+        return self.survey.get_submission_class().objects.filter(
+            page=self.survey, created_at__lt=self.cutoff)
+
+    def archive(self):
+        submissions = self.get_expired_submissions().select_related(
+            'user').order_by('pk')
+        last_pk = 0
+        while True:
+            batch = list(submissions.filter(pk__gt=last_pk)[
+                :self.batch_size])
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+
+            self.write_batch(batch)
+            self.deleter.delete_batch(
+                [submission.pk for submission in batch],
+                set(submission.user_id for submission in batch
+                    if submission.user_id))
+            self.archived += len(batch)
+
+        return self.archived
+
+    def write_batch(self, submissions):
+        lines_by_path = {}
+        for submission in submissions:
+            path = get_archive_path(self.survey.pk, submission.created_at)
+            lines_by_path.setdefault(path, []).append(
+                serialise_submission(submission))
+
+        for path, lines in lines_by_path.items():
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with gzip.open(path, 'ab') as archive:
+                archive.write(
+                    ''.join(line + '\n' for line in lines).encode('utf-8'))
+
+
+def purge_expired_submissions(batch_size=None, now=None):
+    """
+    Archive and delete expired submissions of every survey with a
+    retention period. Returns the number of submissions per survey.
+    """
+    # Refuse to run before anything is archived to a public directory
+    get_archive_dir()
+
+    archived = {}
+    surveys = MoloSurveyPage.objects.filter(retention_days__isnull=False)
+    for survey in surveys.specific():
+        archived[survey.pk] = SubmissionArchiver(
+            survey, batch_size=batch_size, now=now).archive()
+    return archived
@@ -4,6 +4,7 @@ from django import forms
 from django.apps import apps
 from django.core.exceptions import ValidationError
 from django.db import models
+from django.db.models import Case, Count, F, When
 from django.utils import six
 from django.utils.functional import cached_property
 from django.utils.translation import ugettext_lazy as _
@@ -22,29 +23,86 @@ from molo.core.models import ArticlePageTags
 from .edit_handlers import TagPanel
 
 from molo.surveys import blocks
+from molo.surveys.utils import normalise_answer
 
 
 # Filer the Visit Count Page only by articles
 VisitCountRule._meta.verbose_name = 'Page Visit Count Rule'
 
 
+class RuleRegistry(object):
+    """
+    Ordered list of the rule types available to segments.
+
+    The list is built once when the app is ready from the subclasses of
+    ``AbstractBaseRule``. Rules without an ``order`` get one based on their
+    position. Other apps can register rules, optionally with an explicit
+    order, with ``rule_registry.register(MyRule, order=450)``.
+    """
+    def __init__(self):
+        self._rules = []
+        self._ordered = None
+
+    def register(self, rule_class, order=None):
+        if order is not None:
+            rule_class.order = order
+        if rule_class not in self._rules:
+            self._rules.append(rule_class)
+        if self._ordered is not None:
+            self._ordered = self._sort(self._rules)
+        return rule_class
+
+    def populate(self):
+        for rule_class in AbstractBaseRule.__old_subclasses__():
+            if rule_class not in self._rules:
+                self._rules.append(rule_class)
+        self._ordered = self._sort(self._rules)
+
+    @staticmethod
+    def _sort(rules):
+        for i, item in enumerate(rules):
+            if not hasattr(item, 'order'):
+                item.order = (i + 1) * 100
+
+        return sorted(rules, key=attrgetter('order'))
+
+    def get_rules(self):
+        if self._ordered is None:
+            # Apps are not ready yet, so the subclasses may be incomplete.
+            return self._sort(AbstractBaseRule.__old_subclasses__())
+        return self._ordered
+
+
+rule_registry = RuleRegistry()
+
+
 # Add ordering to the base class
 AbstractBaseRule.__old_subclasses__ = AbstractBaseRule.__subclasses__
 
 
 def __ordered_subclasses__(cls):
-    subclasses = cls.__old_subclasses__()
-    for i, item in enumerate(subclasses):
-        if not hasattr(item, 'order'):
-            item.order = (i + 1) * 100
-
-    return sorted(subclasses, key=attrgetter('order'))
+    if cls is AbstractBaseRule:
+        return rule_registry.get_rules()
+    return type.__subclasses__(cls)
 
 
 AbstractBaseRule.__subclasses__ = classmethod(__ordered_subclasses__)
 
 
+def get_user_segment_group_ids(request):
+    """
+    Ids of the segment user groups of the request's user, loaded once
+    per request so that segments with many group rules cost one query.
+    """
+    if not hasattr(request, '_segment_group_ids'):
+        request._segment_group_ids = frozenset(
+            request.user.segment_groups.values_list('id', flat=True))
+    return request._segment_group_ids
+
+
 class SurveySubmissionDataRule(AbstractBaseRule):
+    materialisable = True
+
     EQUALS = 'eq'
     CONTAINS = 'in'
 
@@ -53,6 +111,19 @@ class SurveySubmissionDataRule(AbstractBaseRule):
         (CONTAINS, _('contains')),
     )
 
+    TEXT = 'text'
+    MULTIPLE_CHOICE = 'multiple'
+    BOOLEAN = 'boolean'
+    # The field no longer exists on the survey
+    MISSING = 'missing'
+
+    FIELD_KIND_CHOICES = (
+        (TEXT, _('text')),
+        (MULTIPLE_CHOICE, _('multiple choice')),
+        (BOOLEAN, _('boolean')),
+        (MISSING, _('missing')),
+    )
+
     survey = models.ForeignKey('PersonalisableSurvey',
                                verbose_name=_('survey'),
                                on_delete=models.CASCADE)
@@ -80,6 +151,11 @@ class SurveySubmissionDataRule(AbstractBaseRule):
                     '"Exact" would match responses '
                     'that are exactly the same as the '
                     '"expected response".'))
+    # Kind of the survey's form field, stored so the rule can be evaluated
+    # without building the survey's form.
+    field_kind = models.CharField(
+        max_length=8, choices=FIELD_KIND_CHOICES, blank=True,
+        editable=False)
 
     panels = [
         PageChooserPanel('survey'),
@@ -101,6 +177,12 @@ class SurveySubmissionDataRule(AbstractBaseRule):
 
         return MoloSurveySubmission
 
+    @property
+    def submission_answer_model(self):
+        from molo.surveys.models import MoloSurveySubmissionAnswer
+
+        return MoloSurveySubmissionAnswer
+
     def get_expected_field(self):
         try:
             return self.survey.get_form().fields[self.field_name]
@@ -138,9 +220,62 @@ class SurveySubmissionDataRule(AbstractBaseRule):
             if raise_exceptions:
                 raise
 
+    def get_field_kind(self, field):
+        if field is None:
+            return self.MISSING
+        if isinstance(field, forms.MultipleChoiceField):
+            return self.MULTIPLE_CHOICE
+        if isinstance(field, forms.BooleanField):
+            return self.BOOLEAN
+        return self.TEXT
+
+    def update_field_kind(self, form_fields=None):
+        if form_fields is None:
+            form_fields = self.survey.get_form().fields
+        self.field_kind = self.get_field_kind(
+            form_fields.get(self.field_name))
+
+    @cached_property
+    def expected_value(self):
+        """
+        Expected response converted to the Python value of the field, or
+        None if it cannot be compared against the field.
+        """
+        field_kind = self.field_kind
+        if not field_kind:
+            self.update_field_kind()
+            field_kind = self.field_kind
+            if self.pk is not None:
+                # Store it so later evaluations don't build the form again
+                type(self).objects.filter(pk=self.pk).update(
+                    field_kind=field_kind)
+
+        expected_response = self.expected_response.strip()
+
+        if field_kind == self.MULTIPLE_CHOICE:
+            return [v for v in {v.strip() for v in
+                                expected_response.split(',')}
+                    if v]
+
+        if field_kind == self.BOOLEAN:
+            if expected_response not in ('0', '1'):
+                return None
+            return expected_response == '1'
+
+        if field_kind == self.TEXT:
+            return expected_response
+
+        return None
+
+    def save(self, *args, **kwargs):
+        if self.survey_id:
+            self.update_field_kind()
+        return super(SurveySubmissionDataRule, self).save(*args, **kwargs)
+
     def get_survey_submission_of_user(self, user):
-        return self.survey_submission_model.objects.get(
-            user=user, page_id=self.survey_id)
+        """The id of the user's submission to the survey."""
+        return self.survey_submission_model.objects.values_list(
+            'pk', flat=True).get(user=user, page_id=self.survey_id)
 
     def clean(self):
         # Do not call clean() if we have no survey set.
@@ -173,8 +308,16 @@ class SurveySubmissionDataRule(AbstractBaseRule):
         if not request.user.is_authenticated():
             return False
 
+        python_value = self.expected_value
+
+        if python_value is None:
+            # In case survey has been modified and we cannot obtain Python
+            # value, or the field does no longer exist on the survey,
+            # we want to return false.
+            return False
+
         try:
-            survey_submission = self.get_survey_submission_of_user(
+            submission_id = self.get_survey_submission_of_user(
                 request.user)
         except self.survey_submission_model.DoesNotExist:
             # No survey found so return false
@@ -185,42 +328,42 @@ class SurveySubmissionDataRule(AbstractBaseRule):
             # meant in their response.
             return False
 
-        # Get dict with user's survey submission to a particular question
-        user_response = survey_submission.get_data().get(self.field_name)
+        # Compare user's response in the database against the answers
+        # stored for their submission.
+        answers = self.submission_answer_model.objects.filter(
+            submission_id=submission_id,
+            field_name=self.field_name,
+        )
 
-        if not user_response:
-            return False
+        if isinstance(python_value, list):
+            expected_values = set(normalise_answer(python_value))
+            counts = answers.aggregate(
+                total=Count('pk'),
+                matched=Count(
+                    Case(When(value__in=expected_values, then=F('value'))),
+                    distinct=True,
+                ),
+            )
 
-        python_value = self.get_expected_field_python_value()
+            if not counts['total'] or \
+                    counts['matched'] != len(expected_values):
+                return False
 
-        # Compare user's response
-        try:
-            # Convert lists to sets for easy comparison
-            if isinstance(python_value, list) \
-                    and isinstance(user_response, list):
-                if self.operator == self.CONTAINS:
-                    return set(python_value).issubset(user_response)
+            if self.operator == self.EQUALS:
+                return counts['total'] == len(expected_values)
 
-                if self.operator == self.EQUALS:
-                    return set(python_value) == set(user_response)
+            return True
 
-            if isinstance(python_value, six.string_types) \
-                    and isinstance(user_response, six.string_types):
-                if self.operator == self.CONTAINS:
-                    return python_value.lower() in user_response.lower()
+        expected_values = normalise_answer(python_value)
+        if not expected_values:
+            return False
 
-                return python_value.lower() == user_response.lower()
+        if isinstance(python_value, six.string_types) \
+                and self.operator == self.CONTAINS:
+            return answers.filter(
+                value__contains=expected_values[0]).exists()
 
-            return python_value == user_response
-        except ValidationError:
-            # In case survey has been modified and we cannot obtain Python
-            # value, we want to return false.
-            return False
-        except self.field_model.DoesNotExist:
-            # In case field does not longer exist on the survey
-            # return false. We cannot compare its value if
-            # we do not know its type (hence it needs to be on the survey).
-            return False
+        return answers.filter(value=expected_values[0]).exists()
 
     def description(self):
         try:
@@ -239,6 +382,8 @@ class SurveySubmissionDataRule(AbstractBaseRule):
 
 
 class SurveyResponseRule(AbstractBaseRule):
+    materialisable = True
+
     survey = models.ForeignKey('MoloSurveyPage',
                                verbose_name=_('survey'),
                                on_delete=models.CASCADE)
@@ -272,6 +417,8 @@ class SurveyResponseRule(AbstractBaseRule):
 
 class GroupMembershipRule(AbstractBaseRule):
     """wagtail-personalisation rule based on user's group membership."""
+    materialisable = True
+
     group = models.ForeignKey('surveys.segmentusergroup')
 
     panels = [
@@ -293,7 +440,7 @@ class GroupMembershipRule(AbstractBaseRule):
             return False
 
         # Check whether user is part of a group
-        return request.user.segment_groups.filter(id=self.group_id).exists()
+        return self.group_id in get_user_segment_group_ids(request)
 
 
 class ArticleTagRule(AbstractBaseRule):
@@ -405,6 +552,9 @@ class ArticleTagRule(AbstractBaseRule):
 
 
 class CombinationRule(AbstractBaseRule):
+    # Only combines the other rules of the segment
+    materialisable = True
+
     body = blocks.StreamField([
         ('Rule', blocks.RuleSelectBlock()),
         ('Operator', blocks.AndOrBlock()),
@@ -0,0 +1,128 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+
+from wagtail_personalisation.models import Segment
+from wagtail_personalisation.rules import AbstractBaseRule
+
+
+MATERIALISED_SEGMENTS_CACHE_KEY = 'molo.surveys.materialised_segments'
+
+
+class MaterialisationRequest(object):
+    """
+    Stand-in for a request when rules are evaluated outside of a page view.
+    Materialisable rules only ever look at ``request.user``.
+    """
+    def __init__(self, user):
+        self.user = user
+        self.session = {}
+
+
+def materialisation_enabled():
+    return getattr(settings, 'SURVEYS_MATERIALISE_SEGMENTS', False)
+
+
+def get_materialisation_batch_size():
+    return getattr(settings, 'SURVEYS_MATERIALISE_SEGMENTS_BATCH_SIZE', 500)
+
+
+def is_materialisable(rules):
+    """
+    Rules can be materialised when their result depends only on data
+    stored against the user, not on the session or the time of the request.
+    """
+    return bool(rules) and all(
+        getattr(rule, 'materialisable', False) for rule in rules)
+
+
+def get_segment_rules(segment):
+    rules = []
+    for rule_model in AbstractBaseRule.get_descendant_models():
+        rules.extend(rule_model.objects.filter(segment=segment))
+    return rules
+
+
+def get_materialised_segment_ids():
+    segment_ids = cache.get(MATERIALISED_SEGMENTS_CACHE_KEY)
+    if segment_ids is None:
+        from .models import MaterialisedSegment
+
+        segment_ids = frozenset(
+            MaterialisedSegment.objects.values_list('segment_id', flat=True))
+        cache.set(MATERIALISED_SEGMENTS_CACHE_KEY, segment_ids)
+    return segment_ids
+
+
+def invalidate_materialised_segment(segment_id):
+    """Make the adapter evaluate the segment's rules live again."""
+    from .models import MaterialisedSegment
+
+    MaterialisedSegment.objects.filter(segment_id=segment_id).delete()
+    cache.delete(MATERIALISED_SEGMENTS_CACHE_KEY)
+
+
+def materialise_segment(segment, batch_size=None):
+    """
+    Evaluate the segment's rules for every active user, in batches of
+    ``batch_size`` users, and store the result in the membership table.
+    """
+    from .adapters import evaluate_rules
+    from .models import MaterialisedSegment, SegmentMembership
+
+    batch_size = batch_size or get_materialisation_batch_size()
+
+    invalidate_materialised_segment(segment.pk)
+    SegmentMembership.objects.filter(segment=segment).delete()
+
+    rules = get_segment_rules(segment)
+    if not is_materialisable(rules):
+        return False
+
+    users = get_user_model().objects.filter(is_active=True).order_by('pk')
+    last_pk = 0
+    while True:
+        batch = list(users.filter(pk__gt=last_pk)[:batch_size])
+        if not batch:
+            break
+        last_pk = batch[-1].pk
+
+        SegmentMembership.objects.bulk_create([
+            SegmentMembership(segment=segment, user=user)
+            for user in batch
+            if evaluate_rules(rules, MaterialisationRequest(user),
+                              match_any=segment.match_any)
+        ])
+
+    MaterialisedSegment.objects.update_or_create(segment=segment)
+    cache.delete(MATERIALISED_SEGMENTS_CACHE_KEY)
+    return True
+
+
+def refresh_memberships(users):
+    """Re-evaluate the users against every materialised segment."""
+    from .adapters import evaluate_rules
+    from .models import SegmentMembership
+
+    segments = [
+        (segment, get_segment_rules(segment))
+        for segment in Segment.objects.filter(
+            pk__in=get_materialised_segment_ids())
+    ]
+
+    for user in users:
+        request = MaterialisationRequest(user)
+        for segment, rules in segments:
+            is_member = is_materialisable(rules) and evaluate_rules(
+                rules, request, match_any=segment.match_any)
+
+            if is_member:
+                SegmentMembership.objects.get_or_create(
+                    segment=segment, user=user)
+            else:
+                SegmentMembership.objects.filter(
+                    segment=segment, user=user).delete()
+
+
+def refresh_user_memberships(user):
+    refresh_memberships([user])
@@ -0,0 +1,54 @@
+(function() {
+    var container = document.querySelector('.surveys__results');
+    if (!container) {
+        return;
+    }
+    var percentage = container.getAttribute('data-percentage') === 'true';
+
+    var element = function(tagName, className, text) {
+        var el = document.createElement(tagName);
+        el.className = className || '';
+        if (text !== undefined) {
+            el.textContent = text;
+        }
+        return el;
+    };
+
+    var render = function(results) {
+        container.innerHTML = '';
+        Object.keys(results).forEach(function(question) {
+            container.appendChild(element('h3', 'surveys__question', question));
+            var answers = results[question];
+            Object.keys(answers).forEach(function(answer) {
+                var row = element('div', 'surveys__answer');
+                row.appendChild(element('span', '', answer));
+                row.appendChild(document.createTextNode(
+                    ' ' + answers[answer] + (percentage ? '%' : '')));
+                container.appendChild(row);
+            });
+        });
+    };
+
+    var interval = parseFloat(
+        container.getAttribute('data-poll-interval')) * 1000;
+    var version = '';
+    var poll = function() {
+        var request = new XMLHttpRequest();
+        request.open('GET', container.getAttribute('data-poll-url'));
+        request.onload = function() {
+            if (request.status === 200) {
+                var data = JSON.parse(request.responseText);
+                if (data.version !== version) {
+                    version = data.version;
+                    render(data.results);
+                }
+            }
+            setTimeout(poll, interval);
+        };
+        request.onerror = function() {
+            setTimeout(poll, interval);
+        };
+        request.send();
+    };
+    setTimeout(poll, interval);
+})();
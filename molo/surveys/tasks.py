@@ -0,0 +1,127 @@
+import os
+
+from celery import task
+
+from django.contrib.auth import get_user_model
+from django.utils.dateparse import parse_date, parse_datetime
+
+from wagtail.wagtailcore.models import Page
+from wagtail_personalisation.models import Segment
+
+from .conversion import SubmissionArticleConverter
+from .deletion import SubmissionDeleter, filter_submissions
+from .importers import (
+    CSVImportError,
+    SegmentUserGroupImporter,
+    set_import_summary,
+)
+from .models import MaterialisedSegment, SegmentUserGroup
+from .retention import purge_expired_submissions
+from .segments import (
+    materialise_segment,
+    refresh_memberships,
+    refresh_user_memberships,
+)
+
+
+@task(ignore_result=True)
+def materialise_segment_memberships(segment_id=None, requested_at=None):
+    """
+    Evaluate enabled segments for all users and store the memberships.
+    Pass ``segment_id`` to only materialise a single segment. Segments
+    materialised again since ``requested_at`` (an ISO datetime) are
+    skipped.
+    """
+    segments = Segment.objects.filter(status=Segment.STATUS_ENABLED)
+    if segment_id is not None:
+        segments = segments.filter(pk=segment_id)
+
+    for segment in segments:
+        if requested_at is not None and MaterialisedSegment.objects.filter(
+                segment=segment,
+                materialised_at__gte=parse_datetime(requested_at),
+        ).exists():
+            continue
+        materialise_segment(segment)
+
+
+@task(ignore_result=True)
+def refresh_user_segment_memberships(user_id):
+    try:
+        user = get_user_model().objects.get(pk=user_id)
+    except get_user_model().DoesNotExist:
+        return
+
+    refresh_user_memberships(user)
+
+
+@task(ignore_result=True)
+def refresh_users_segment_memberships(user_ids):
+    refresh_memberships(
+        get_user_model().objects.filter(pk__in=user_ids).order_by('pk'))
+
+
+@task(ignore_result=True)
+def import_segment_user_group_csv(group_id, path, sync=False):
+    """
+    Import a CSV file of usernames saved by ``save_csv_upload``, deleting
+    it afterwards. With ``sync`` the group's members are replaced by the
+    users in the file.
+    """
+    try:
+        group = SegmentUserGroup.objects.get(pk=group_id)
+        importer = SegmentUserGroupImporter(group)
+        with open(path, 'rb') as csv_file:
+            if sync:
+                importer.sync_csv(csv_file)
+            else:
+                importer.import_csv(csv_file)
+        set_import_summary(group, importer.get_summary())
+    except CSVImportError as error:
+        set_import_summary(group, {'error': str(error)})
+    except SegmentUserGroup.DoesNotExist:
+        pass
+    finally:
+        os.remove(path)
+
+
+@task(ignore_result=True)
+def convert_submissions_to_articles(survey_id, index_page_id,
+                                    submission_ids=None):
+    """
+    Convert a survey's submissions to articles under the index page.
+    Without ``submission_ids`` every submission that has no article yet is
+    converted.
+    """
+    survey = Page.objects.get(pk=survey_id).specific
+    index_page = Page.objects.get(pk=index_page_id)
+
+    submissions = survey.get_submission_class().objects.all()
+    if submission_ids is not None:
+        submissions = submissions.filter(pk__in=submission_ids)
+
+    SubmissionArticleConverter(survey, index_page).convert(submissions)
+
+
+@task(ignore_result=True)
+def delete_submissions(survey_id, filters):
+    """
+    Delete the survey's submissions matching the filters of
+    ``filter_submissions``, with dates given as ISO strings.
+    """
+    survey = Page.objects.get(pk=survey_id).specific
+    for name in ('date_from', 'date_to'):
+        if filters.get(name):
+            filters[name] = parse_date(filters[name])
+
+    SubmissionDeleter(survey).delete(
+        filter_submissions(survey, **filters))
+
+
+@task(ignore_result=True)
+def purge_survey_submissions():
+    """
+    Archive and delete submissions older than their survey's retention
+    period. Meant to be run daily from Celery beat.
+    """
+    purge_expired_submissions()
@@ -1,9 +1,14 @@
+import uuid
+
 from django import template
 from django.forms.fields import MultipleChoiceField
+from django.utils.html import format_html
 
 from copy import copy
 from wagtail.wagtailcore.models import Page
-from molo.surveys.models import MoloSurveyPage, SurveysIndexPage
+from molo.surveys.models import (
+    MoloSurveyPage, SurveyResponseCounter, SurveysIndexPage)
+from molo.surveys.utils import IDEMPOTENCY_TOKEN_FIELD, get_idempotency_token
 
 from molo.core.templatetags.core_tags import get_pages
 from django.shortcuts import get_object_or_404
@@ -58,7 +63,9 @@ def add_form_objects_to_surveys(context):
     surveys = []
     for survey in context['surveys']:
         form = None
-        if (survey.allow_multiple_submissions_per_user or
+        quota_reached = survey.is_quota_reached()
+        if not quota_reached and (
+                survey.allow_multiple_submissions_per_user or
                 not survey.has_user_submitted_survey(
                     context['request'], survey.id)):
             form = survey.get_form()
@@ -66,6 +73,7 @@ def add_form_objects_to_surveys(context):
         surveys.append({
             'molo_survey_page': survey,
             'form': form,
+            'quota_reached': quota_reached,
         })
 
     context.update({
@@ -130,6 +138,59 @@ def surveys_list_for_pages(context, pk=None, page=None):
     return add_form_objects_to_surveys(context)
 
 
+@register.filter
+def with_article_page_ids(data_rows, submissions):
+    """
+    Add the id of the article each submission was converted to onto the
+    submissions listing rows, from the page of submissions that was
+    already fetched for the listing.
+    """
+    article_page_ids = dict(
+        (submission.pk, submission.article_page_id)
+        for submission in submissions
+    )
+    for row in data_rows:
+        row.setdefault(
+            'article_page_id', article_page_ids.get(row['model_id']))
+    return data_rows
+
+
+@register.filter
+def with_submission_counts(survey_pages):
+    """
+    Add the number of submissions and the time of the latest one onto each
+    survey page, from their counters fetched in a single query.
+    """
+    survey_pages = list(survey_pages or [])
+    counters = dict(
+        (counter.page_id, counter)
+        for counter in SurveyResponseCounter.objects.filter(
+            page_id__in=[survey_page.pk for survey_page in survey_pages])
+    )
+    for survey_page in survey_pages:
+        counter = counters.get(survey_page.pk)
+        survey_page.submission_count = counter.count if counter else 0
+        survey_page.last_submission_at = (
+            counter.last_submission_at if counter else None)
+    return survey_pages
+
+
+@register.simple_tag(takes_context=True)
+def survey_idempotency_token(context):
+    """
+    Hidden input identifying one filling in of a survey form, so retried
+    submissions of it are only saved once. The posted token is kept across
+    the steps of a multi-step survey.
+    """
+    request = context.get('request')
+    token = None
+    if request is not None and request.method == 'POST':
+        token = get_idempotency_token(request)
+    return format_html(
+        '<input type="hidden" name="{}" value="{}" />',
+        IDEMPOTENCY_TOKEN_FIELD, token or uuid.uuid4().hex)
+
+
 @register.filter(name='is_multiple_choice_field')
 def is_multiple_choice_field(value):
     return isinstance(value.field, MultipleChoiceField)
@@ -1,19 +1,36 @@
+import threading
+
 from django.contrib.auth import get_user_model
-from django.test import TestCase, RequestFactory
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase, RequestFactory
 from django.test.client import Client
+from django.test.utils import CaptureQueriesContext
 
+from wagtail_personalisation.models import Segment
 from wagtail_personalisation.rules import UserIsLoggedInRule
 
 from molo.core.models import Main
 from molo.core.tests.base import MoloTestCaseMixin
 
 from molo.surveys.adapters import (
+    SurveysSegmentsAdapter,
+    evaluate_rules,
     get_rule,
     index_rules_by_type,
     transform_into_boolean_list,
     evaluate,
 )
-from molo.surveys.models import SegmentUserGroup
+from molo.surveys.models import (
+    MaterialisedSegment,
+    SegmentMembership,
+    SegmentUserGroup,
+)
+from molo.surveys.segments import materialise_segment
+from molo.surveys.tasks import refresh_users_segment_memberships
+from molo.surveys.tracing import (
+    clear_traces, get_traces, summarise_traces, trace)
 
 from molo.surveys.rules import GroupMembershipRule
 
@@ -184,3 +201,202 @@ class TestAdapterUtils(TestCase, MoloTestCaseMixin):
             evaluate(
                 [[False, "or", True]])
         )
+
+
+class TestSegmentMaterialisation(TestCase, MoloTestCaseMixin):
+    def setUp(self):
+        self.mk_main()
+        self.request = RequestFactory().get('/')
+        SessionMiddleware().process_request(self.request)
+        self.request.user = get_user_model().objects.create_user(
+            username='tester', email='tester@example.com', password='tester')
+        self.other_user = get_user_model().objects.create_user(
+            username='other', email='other@example.com', password='other')
+
+        self.group = SegmentUserGroup.objects.create(name='Group 1')
+        self.group.users.add(self.request.user)
+
+        self.segment = Segment.objects.create(name='Group segment')
+        self.rule = GroupMembershipRule.objects.create(
+            segment=self.segment, group=self.group)
+
+    def test_materialise_segment(self):
+        self.assertTrue(materialise_segment(self.segment, batch_size=1))
+
+        self.assertTrue(MaterialisedSegment.objects.filter(
+            segment=self.segment).exists())
+        self.assertEqual(
+            list(SegmentMembership.objects.filter(
+                segment=self.segment).values_list('user_id', flat=True)),
+            [self.request.user.pk])
+
+    def test_segment_with_session_rules_is_not_materialised(self):
+        UserIsLoggedInRule.objects.create(
+            segment=self.segment, is_logged_in=True)
+
+        self.assertFalse(materialise_segment(self.segment))
+        self.assertFalse(MaterialisedSegment.objects.exists())
+        self.assertFalse(SegmentMembership.objects.exists())
+
+    def test_adapter_reads_materialised_memberships(self):
+        materialise_segment(self.segment)
+        adapter = SurveysSegmentsAdapter(self.request)
+        adapter.materialised_segment_ids
+
+        # One query for the memberships, none for the rule itself
+        with self.assertNumQueries(1):
+            self.assertTrue(
+                adapter._test_rules([self.rule], self.request))
+
+    def test_refresh_does_not_evaluate_materialised_segments(self):
+        materialise_segment(self.segment)
+        adapter = SurveysSegmentsAdapter(self.request)
+
+        with CaptureQueriesContext(connection) as queries:
+            adapter.refresh()
+
+        self.assertEqual(
+            [segment.pk for segment in adapter.get_segments()],
+            [self.segment.pk])
+        group_table = SegmentUserGroup.users.through._meta.db_table
+        self.assertFalse(any(
+            group_table in query['sql'] for query in queries.captured_queries))
+
+    def test_saving_segment_invalidates_materialisation(self):
+        materialise_segment(self.segment)
+        self.segment.save()
+
+        self.assertFalse(MaterialisedSegment.objects.exists())
+
+    def test_saving_rule_invalidates_materialisation(self):
+        materialise_segment(self.segment)
+        self.rule.save()
+
+        self.assertFalse(MaterialisedSegment.objects.exists())
+
+    def test_refresh_memberships_of_a_batch_of_users(self):
+        materialise_segment(self.segment)
+        SegmentUserGroup.users.through.objects.all().delete()
+        self.group.users.through.objects.create(
+            segmentusergroup=self.group, user=self.other_user)
+
+        refresh_users_segment_memberships(
+            [self.request.user.pk, self.other_user.pk])
+
+        self.assertEqual(
+            list(SegmentMembership.objects.filter(
+                segment=self.segment).values_list('user_id', flat=True)),
+            [self.other_user.pk])
+
+
+class TestRuleTracing(TestCase, MoloTestCaseMixin):
+    def setUp(self):
+        self.mk_main()
+        self.request = RequestFactory().get('/')
+        self.request.user = get_user_model().objects.create_user(
+            username='tester', email='tester@example.com', password='tester')
+        self.group = SegmentUserGroup.objects.create(name='Group 1')
+        self.rule = GroupMembershipRule(group=self.group)
+        clear_traces()
+
+    def test_rules_are_not_traced_by_default(self):
+        evaluate_rules([self.rule], self.request)
+
+        self.assertEqual(get_traces(), [])
+
+    def test_rule_evaluations_are_traced(self):
+        sinks = ['molo.surveys.tracing.CacheRingBufferTraceSink']
+        with self.settings(SURVEYS_RULE_TRACE_SINKS=sinks, DEBUG=True):
+            evaluate_rules([self.rule], self.request)
+
+        [record] = get_traces()
+        self.assertEqual(record['rule'], 'GroupMembershipRule')
+        self.assertEqual(record['queries'], 1)
+        self.assertFalse(record['result'])
+
+        [row] = summarise_traces(get_traces())
+        self.assertEqual(row['count'], 1)
+        self.assertEqual(row['p50'], record['time'])
+
+    def test_segment_traces_count_queries_on_other_threads(self):
+        def run_query():
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+
+        def run_rule_on_thread():
+            parent = self.request._rule_trace
+            thread = threading.Thread(target=lambda: trace(
+                run_query, None, 'Rule', None, parent=parent))
+            thread.start()
+            thread.join()
+            return True
+
+        sinks = ['molo.surveys.tracing.CacheRingBufferTraceSink']
+        with self.settings(SURVEYS_RULE_TRACE_SINKS=sinks, DEBUG=True):
+            trace(run_rule_on_thread, None, 'Segment', None, self.request)
+
+        rule, segment = get_traces()
+        self.assertEqual(rule['queries'], 1)
+        self.assertEqual(segment['queries'], 1)
+        self.assertFalse(hasattr(self.request, '_rule_trace'))
+
+    def test_queries_are_only_counted_when_logged(self):
+        sinks = ['molo.surveys.tracing.CacheRingBufferTraceSink']
+        with self.settings(SURVEYS_RULE_TRACE_SINKS=sinks):
+            evaluate_rules([self.rule], self.request)
+
+        [record] = get_traces()
+        self.assertIsNone(record['queries'])
+        self.assertFalse(connection.force_debug_cursor)
+        [row] = summarise_traces(get_traces())
+        self.assertIsNone(row['queries'])
+
+
+class ThreadRecordingRule(object):
+    materialisable = True
+    pk = None
+    segment_id = None
+
+    def __init__(self, result):
+        self.result = result
+        self.thread = None
+
+    def test_user(self, request):
+        self.thread = threading.current_thread()
+        return self.result
+
+
+class TestParallelRuleEvaluation(TransactionTestCase):
+    def setUp(self):
+        self.request = RequestFactory().get('/')
+        self.request.user = AnonymousUser()
+
+    def test_rules_are_evaluated_in_request_thread_by_default(self):
+        rules = [ThreadRecordingRule(True), ThreadRecordingRule(True)]
+
+        self.assertTrue(evaluate_rules(rules, self.request))
+        self.assertEqual(
+            [rule.thread for rule in rules],
+            [threading.current_thread()] * 2)
+
+    def test_rules_are_evaluated_on_pool(self):
+        rules = [ThreadRecordingRule(True), ThreadRecordingRule(False)]
+
+        with self.settings(SURVEYS_PARALLEL_RULE_THREADS=2):
+            self.assertFalse(evaluate_rules(rules, self.request))
+            self.assertTrue(
+                evaluate_rules(rules, self.request, match_any=True))
+
+        for rule in rules:
+            self.assertNotEqual(rule.thread, threading.current_thread())
+
+    def test_rules_are_evaluated_in_request_thread_in_transaction(self):
+        rules = [ThreadRecordingRule(True), ThreadRecordingRule(True)]
+
+        with self.settings(SURVEYS_PARALLEL_RULE_THREADS=2):
+            with transaction.atomic():
+                self.assertTrue(evaluate_rules(rules, self.request))
+
+        self.assertEqual(
+            [rule.thread for rule in rules],
+            [threading.current_thread()] * 2)
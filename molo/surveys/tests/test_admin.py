@@ -1,11 +1,30 @@
+import json
+import os
+import shutil
+import tempfile
+
 from django.contrib.auth import get_user_model
-from django.test import TestCase
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.db.models.signals import m2m_changed
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.test.client import Client
 
 from molo.core.models import SiteLanguageRelation, Main, Languages, ArticlePage
 from molo.core.tests.base import MoloTestCaseMixin
+from molo.surveys.conversion import (
+    SubmissionArticleConverter, get_conversion_progress)
+from molo.surveys.deletion import (
+    SubmissionDeleter, filter_submissions, get_deletion_progress)
+from molo.surveys.importers import CSVImportError, SegmentUserGroupImporter
 from molo.surveys.models import (MoloSurveyPage, MoloSurveyFormField,
-                                 SurveysIndexPage)
+                                 MoloSurveySubmission,
+                                 MoloSurveySubmissionAnswer,
+                                 PersonalisableSurvey,
+                                 PersonalisableSurveyFormField,
+                                 SegmentUserGroup, SurveysIndexPage)
 
 
 User = get_user_model()
@@ -144,3 +163,268 @@ class TestSurveyAdminViews(TestCase, MoloTestCaseMixin):
         self.assertNotContains(response, molo_survey_form_field.label)
         self.assertContains(response, molo_survey_form_field.admin_label)
         self.assertContains(response, answer)
+
+    def test_bulk_convert_to_articles(self):
+        molo_survey_page, molo_survey_form_field = \
+            self.create_molo_survey_page(
+                parent=self.section_index,
+                allow_multiple_submissions_per_user=True)
+        field_name = molo_survey_form_field.label.lower().replace(' ', '-')
+
+        self.client.force_login(self.user)
+        for answer in ['python', 'django', 'wagtail']:
+            self.client.post(molo_survey_page.url, {field_name: answer})
+
+        submissions = molo_survey_page.get_submission_class().objects.all()
+        converter = SubmissionArticleConverter(
+            molo_survey_page, self.surveys_index, batch_size=2)
+        article_ids = converter.convert(submissions)
+
+        self.assertEqual(len(article_ids), 3)
+        self.assertEqual(get_conversion_progress(molo_survey_page.pk), {
+            'total': 3, 'converted': 3, 'done': True})
+        self.surveys_index.refresh_from_db()
+        children = self.surveys_index.get_children()
+        self.assertEqual(
+            list(children.values_list('pk', flat=True))[-3:], article_ids)
+        self.assertEqual(self.surveys_index.numchild, children.count())
+        for submission in submissions:
+            self.assertEqual(
+                submission.article_page.title,
+                'yourwords-entry-%s' % submission.pk)
+            self.assertFalse(submission.article_page.live)
+
+        # Converted submissions are skipped
+        self.assertEqual(converter.convert(submissions), [])
+
+        self.client.force_login(self.super_user)
+        response = self.client.get(reverse(
+            'survey-submissions-convert', args=(molo_survey_page.pk,)))
+        self.assertContains(
+            response, '0 submission(s) were converted to articles.')
+
+    def test_submissions_listing_queries_do_not_grow_with_rows(self):
+        molo_survey_page, molo_survey_form_field = \
+            self.create_molo_survey_page(
+                parent=self.section_index,
+                allow_multiple_submissions_per_user=True)
+        field_name = molo_survey_form_field.label.lower().replace(' ', '-')
+        url = '/admin/surveys/submissions/%s/' % molo_survey_page.id
+
+        def listing_queries():
+            self.client.force_login(self.super_user)
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            return len(queries)
+
+        self.client.force_login(self.user)
+        self.client.post(molo_survey_page.url, {field_name: 'python'})
+        one_row = listing_queries()
+
+        self.client.force_login(self.user)
+        for answer in ['django', 'wagtail']:
+            self.client.post(molo_survey_page.url, {field_name: answer})
+        self.assertEqual(listing_queries(), one_row)
+
+    def test_personalisable_submissions_listing_queries(self):
+        survey = PersonalisableSurvey(title='Personalisable Survey')
+        self.surveys_index.add_child(instance=survey)
+        survey.save_revision().publish()
+        PersonalisableSurveyFormField.objects.create(
+            page=survey, field_type='singleline', label='Question 1')
+        url = reverse('survey-submissions-list', args=(survey.pk,))
+
+        def listing_queries():
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            return len(queries)
+
+        def submit(user, answer):
+            MoloSurveySubmission.objects.create(
+                page=survey, user=user,
+                form_data=json.dumps({'question-1': answer}))
+
+        self.client.force_login(self.super_user)
+        submit(self.user, 'python')
+        one_row = listing_queries()
+
+        submit(self.user, 'django')
+        submit(None, 'wagtail')
+        self.assertEqual(listing_queries(), one_row)
+
+    @override_settings(SURVEYS_SUBMISSIONS_PER_PAGE=2)
+    def test_keyset_paginated_submissions_listing(self):
+        molo_survey_page, molo_survey_form_field = \
+            self.create_molo_survey_page(
+                parent=self.section_index,
+                allow_multiple_submissions_per_user=True)
+        field_name = molo_survey_form_field.label.lower().replace(' ', '-')
+
+        self.client.force_login(self.user)
+        for answer in ['python', 'django', 'wagtail']:
+            self.client.post(molo_survey_page.url, {field_name: answer})
+
+        self.client.force_login(self.super_user)
+        url = reverse('survey-submissions-list', args=(molo_survey_page.pk,))
+        response = self.client.get(url)
+        self.assertEqual(
+            [row['fields'][-1] for row in response.context['data_rows']],
+            ['wagtail', 'django'])
+        self.assertIsNone(response.context['newer_url'])
+
+        response = self.client.get(url + response.context['older_url'])
+        self.assertEqual(
+            [row['fields'][-1] for row in response.context['data_rows']],
+            ['python'])
+        self.assertIsNone(response.context['older_url'])
+
+        response = self.client.get(url + response.context['newer_url'])
+        self.assertEqual(
+            [row['fields'][-1] for row in response.context['data_rows']],
+            ['wagtail', 'django'])
+
+        response = self.client.get(url, {'date_to': '2000-01-01'})
+        self.assertEqual(response.context['data_rows'], [])
+
+    def test_bulk_delete_submissions(self):
+        molo_survey_page, molo_survey_form_field = \
+            self.create_molo_survey_page(
+                parent=self.section_index,
+                allow_multiple_submissions_per_user=True)
+        field_name = molo_survey_form_field.label.lower().replace(' ', '-')
+
+        self.client.force_login(self.user)
+        for answer in ['python', 'Django', 'django']:
+            self.client.post(molo_survey_page.url, {field_name: answer})
+
+        deleter = SubmissionDeleter(molo_survey_page, batch_size=1)
+        deleter.delete(filter_submissions(
+            molo_survey_page, field_name=field_name, answer='DJANGO'))
+
+        self.assertEqual(deleter.deleted, 2)
+        self.assertEqual(get_deletion_progress(molo_survey_page.pk), {
+            'total': 2, 'deleted': 2, 'done': True})
+        submissions = molo_survey_page.get_submission_class().objects.all()
+        self.assertEqual(submissions.count(), 1)
+        self.assertEqual(
+            list(MoloSurveySubmissionAnswer.objects.values_list(
+                'value', flat=True)),
+            ['python'])
+
+        # Deleting every submission has to be asked for explicitly
+        self.client.force_login(self.super_user)
+        response = self.client.post(reverse(
+            'survey-submissions-delete', args=(molo_survey_page.pk,)), {})
+        self.assertContains(response, 'Please filter the submissions')
+        self.assertEqual(submissions.count(), 1)
+
+
+class TestSegmentUserGroupImport(TestCase, MoloTestCaseMixin):
+    def setUp(self):
+        self.client = Client()
+        self.mk_main()
+        self.group = SegmentUserGroup.objects.create(name='Group')
+        self.users = [
+            User.objects.create_user(username='user%s' % i, password='pass')
+            for i in range(3)
+        ]
+        self.group.users.add(self.users[0])
+        self.super_user = User.objects.create_superuser(
+            username='testuser', password='password', email='test@email.com')
+
+    def csv_file(self, content):
+        return SimpleUploadedFile('users.csv', content, 'text/csv')
+
+    def test_import_adds_users_in_batches(self):
+        importer = SegmentUserGroupImporter(self.group, batch_size=2)
+        importer.import_csv(self.csv_file(
+            b'username,email\nuser0,a@b.com\nuser1,c@d.com\n'
+            b'unknown,e@f.com\nuser2,g@h.com\n'))
+
+        self.assertEqual(importer.added, 2)
+        self.assertEqual(importer.unknown, 1)
+        self.assertEqual(importer.unknown_sample, ['unknown'])
+        self.assertEqual(
+            set(self.group.users.all()), set(self.users))
+
+    def test_import_view(self):
+        self.client.force_login(self.super_user)
+        url = reverse('segment-user-group-import', args=(self.group.pk,))
+
+        response = self.client.post(url, {
+            'csv_file': self.csv_file(b'username,email\nuser1,c@d.com\n'),
+        }, follow=True)
+
+        self.assertContains(response, 'Added 1 and removed 0 user(s)')
+        self.assertTrue(self.group.users.filter(username='user1').exists())
+
+    def test_large_import_is_saved_outside_media(self):
+        self.client.force_login(self.super_user)
+        upload_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, upload_dir)
+        url = reverse('segment-user-group-import', args=(self.group.pk,))
+
+        with self.settings(SURVEYS_CSV_IMPORT_SYNC_LIMIT=0,
+                           SURVEYS_CSV_IMPORT_DIR=upload_dir):
+            response = self.client.post(url, {
+                'csv_file': self.csv_file(b'username,email\nuser1,c@d.com\n'),
+            }, follow=True)
+
+        self.assertContains(response, 'is being imported')
+        self.assertTrue(self.group.users.filter(username='user1').exists())
+        # The worker deletes the file once it is imported
+        self.assertEqual(os.listdir(upload_dir), [])
+
+    def test_sync_only_applies_differences(self):
+        self.group.users.add(self.users[1])
+        importer = SegmentUserGroupImporter(self.group, batch_size=2)
+        changes = []
+
+        def record(sender, action, pk_set, **kwargs):
+            changes.append((action, set(pk_set)))
+
+        m2m_changed.connect(record, sender=SegmentUserGroup.users.through)
+        try:
+            importer.sync_csv(self.csv_file(
+                b'username,email\nuser2,g@h.com\nuser1,c@d.com\n'
+                b'user2,g@h.com\n'))
+        finally:
+            m2m_changed.disconnect(
+                record, sender=SegmentUserGroup.users.through)
+
+        self.assertEqual(importer.added, 1)
+        self.assertEqual(importer.removed, 1)
+        self.assertEqual(
+            set(self.group.users.all()), set(self.users[1:]))
+        self.assertEqual(changes, [
+            ('pre_add', {self.users[2].pk}),
+            ('post_add', {self.users[2].pk}),
+            ('pre_remove', {self.users[0].pk}),
+            ('post_remove', {self.users[0].pk}),
+        ])
+
+    def test_sync_refuses_file_without_known_users(self):
+        importer = SegmentUserGroupImporter(self.group)
+
+        with self.assertRaises(CSVImportError):
+            importer.sync_csv(self.csv_file(
+                b'username,email\nunknown,e@f.com\nother,g@h.com\n'))
+
+        self.assertEqual(importer.removed, 0)
+        self.assertEqual(list(self.group.users.all()), [self.users[0]])
+
+    def test_sync_refuses_file_with_too_many_unknown_users(self):
+        importer = SegmentUserGroupImporter(self.group)
+        content = (b'username,email\nuser1,c@d.com\n'
+                   b'unknown,e@f.com\nother,g@h.com\n')
+
+        with self.assertRaises(CSVImportError):
+            importer.sync_csv(self.csv_file(content))
+        self.assertEqual(list(self.group.users.all()), [self.users[0]])
+
+        with self.settings(SURVEYS_GROUP_SYNC_MAX_UNKNOWN_RATIO=0.7):
+            SegmentUserGroupImporter(self.group).sync_csv(
+                self.csv_file(content))
+        self.assertEqual(list(self.group.users.all()), [self.users[1]])
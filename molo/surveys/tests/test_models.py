@@ -1,12 +1,34 @@
-from django.core.exceptions import ValidationError
-from django.test import TestCase
+import datetime
+import json
+import os
+import shutil
+import tempfile
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.core.management import call_command
+from django.db import connection
+from django.test import RequestFactory, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.six import StringIO
 from molo.core.tests.base import MoloTestCaseMixin
 from molo.surveys.blocks import SkipLogicBlock, SkipState
 from molo.surveys.models import (
     MoloSurveyFormField,
     MoloSurveyPage,
     MoloSurveySubmission,
+    PersonalisableSurvey,
+    PersonalisableSurveyFormField,
+    SurveyResponseCounter,
+    SurveysIndexPage,
 )
+from molo.surveys.retention import (
+    purge_expired_submissions, read_archived_submissions)
+from molo.surveys.utils import COMPRESSED_FORM_DATA_PREFIX, compress_form_data
+from wagtail_personalisation.models import Segment
 
 from .utils import skip_logic_block_data, skip_logic_data
 
@@ -23,6 +45,219 @@ class TestSurveyModels(TestCase, MoloTestCaseMixin):
         ).get_data()
         self.assertIn('username', data)
 
+    def test_compressed_form_data_is_decompressed_by_get_data(self):
+        form_data = json.dumps({'entry': 'Once upon a time ' * 100})
+        compressed = compress_form_data(form_data, threshold=1024)
+
+        self.assertTrue(compressed.startswith(COMPRESSED_FORM_DATA_PREFIX))
+        self.assertLess(len(compressed), len(form_data))
+        self.assertEqual(compress_form_data(form_data, threshold=None),
+                         form_data)
+
+        data = MoloSurveySubmission(form_data=compressed).get_data()
+        self.assertEqual(data['entry'], 'Once upon a time ' * 100)
+
+    def test_compress_existing_submissions(self):
+        self.mk_main()
+        survey = MoloSurveyPage(title='Test Survey')
+        SurveysIndexPage.objects.first().add_child(instance=survey)
+        long_entry = MoloSurveySubmission.objects.create(
+            page=survey, form_data=json.dumps({'entry': 'words ' * 500}))
+        short_entry = MoloSurveySubmission.objects.create(
+            page=survey, form_data=json.dumps({'entry': 'words'}))
+
+        out = StringIO()
+        call_command('compress_survey_submissions', batch_size=1, stdout=out)
+
+        self.assertIn('Compressed 1 submission(s)', out.getvalue())
+        long_entry.refresh_from_db()
+        short_entry.refresh_from_db()
+        self.assertTrue(
+            long_entry.form_data.startswith(COMPRESSED_FORM_DATA_PREFIX))
+        self.assertEqual(long_entry.get_data()['entry'], 'words ' * 500)
+        self.assertEqual(short_entry.form_data, '{"entry": "words"}')
+
+
+class TestSubmissionCounters(TestCase, MoloTestCaseMixin):
+    def setUp(self):
+        self.mk_main()
+        self.survey = MoloSurveyPage(title='Test Survey')
+        SurveysIndexPage.objects.first().add_child(instance=self.survey)
+
+    def get_counter(self):
+        return SurveyResponseCounter.objects.get(page_id=self.survey.pk)
+
+    def test_counter_is_created_with_survey(self):
+        self.assertEqual(self.get_counter().count, 0)
+
+        with CaptureQueriesContext(connection) as queries:
+            MoloSurveySubmission.objects.create(
+                page=self.survey, form_data='{}')
+
+        counter_queries = [
+            query['sql'] for query in queries
+            if SurveyResponseCounter._meta.db_table in query['sql']]
+        self.assertEqual(len(counter_queries), 1)
+        self.assertTrue(counter_queries[0].startswith('UPDATE'))
+        self.assertEqual(self.get_counter().count, 1)
+
+    def test_counter_follows_created_and_deleted_submissions(self):
+        first = MoloSurveySubmission.objects.create(
+            page=self.survey, form_data='{}')
+        second = MoloSurveySubmission.objects.create(
+            page=self.survey, form_data='{}')
+
+        counter = self.get_counter()
+        self.assertEqual(counter.count, 2)
+        self.assertEqual(counter.last_submission_at, second.created_at)
+
+        second.delete()
+        counter = self.get_counter()
+        self.assertEqual(counter.count, 1)
+        self.assertEqual(counter.last_submission_at, first.created_at)
+
+    def test_reconcile_command_corrects_drifted_counters(self):
+        MoloSurveySubmission.objects.create(page=self.survey, form_data='{}')
+        SurveyResponseCounter.objects.filter(page_id=self.survey.pk).update(
+            count=5)
+
+        out = StringIO()
+        call_command('reconcile_survey_counters', stdout=out)
+
+        self.assertIn('5 -> 1 submission(s)', out.getvalue())
+        self.assertIn('corrected 1', out.getvalue())
+        self.assertEqual(self.get_counter().count, 1)
+
+
+class TestSingleSubmissionUsers(TestCase, MoloTestCaseMixin):
+    def setUp(self):
+        self.mk_main()
+        self.survey = MoloSurveyPage(
+            title='Test Survey', allow_multiple_submissions_per_user=True)
+        SurveysIndexPage.objects.first().add_child(instance=self.survey)
+        self.users = [
+            get_user_model().objects.create_user(
+                username='tester%s' % i, password='tester')
+            for i in range(2)
+        ]
+
+    def test_switching_to_single_submission_marks_first_submissions(self):
+        first = MoloSurveySubmission.objects.create(
+            page=self.survey, user=self.users[0], form_data='{}')
+        MoloSurveySubmission.objects.create(
+            page=self.survey, user=self.users[0], form_data='{}')
+        marked = MoloSurveySubmission.objects.create(
+            page=self.survey, user=self.users[1], form_data='{}',
+            single_submission_user=self.users[1])
+        MoloSurveySubmission.objects.create(
+            page=self.survey, user=self.users[1], form_data='{}')
+        MoloSurveySubmission.objects.create(
+            page=self.survey, form_data='{}')
+
+        self.survey.allow_multiple_submissions_per_user = False
+        self.survey.save_revision().publish()
+
+        self.assertEqual(
+            sorted(MoloSurveySubmission.objects.filter(
+                single_submission_user__isnull=False,
+            ).values_list('pk', flat=True)),
+            [first.pk, marked.pk])
+
+
+class TestPersonalisableSurveyFormFields(TestCase, MoloTestCaseMixin):
+    def setUp(self):
+        self.mk_main()
+        self.survey = PersonalisableSurvey(title='Test Survey')
+        SurveysIndexPage.objects.first().add_child(instance=self.survey)
+
+        self.segment = Segment.objects.create(name='Segment', persistent=True)
+        other_segment = Segment.objects.create(
+            name='Other segment', persistent=True)
+
+        self.field = PersonalisableSurveyFormField.objects.create(
+            field_type='singleline', label='Question 1', page=self.survey)
+        self.segmented_field = PersonalisableSurveyFormField.objects.create(
+            field_type='singleline', label='Question 2', page=self.survey,
+            segment=self.segment)
+        PersonalisableSurveyFormField.objects.create(
+            field_type='singleline', label='Question 3', page=self.survey,
+            segment=other_segment)
+
+        request = RequestFactory().get('/')
+        SessionMiddleware().process_request(request)
+        request.user = AnonymousUser()
+        request.session['segments'] = [{'id': self.segment.id}]
+        self.survey.request = request
+
+    def test_form_fields_for_user_segments(self):
+        self.assertEqual(self.survey.get_form_fields(),
+                         [self.field, self.segmented_field])
+
+    def test_form_fields_are_looked_up_once_per_request(self):
+        self.survey.get_form_fields()
+
+        with self.assertNumQueries(0):
+            self.assertEqual(len(self.survey.get_form_fields()), 2)
+            self.assertFalse(self.survey.has_page_breaks)
+
+
+class TestSubmissionRetention(TestCase, MoloTestCaseMixin):
+    def setUp(self):
+        self.mk_main()
+        self.survey = MoloSurveyPage(title='Test Survey', retention_days=30)
+        SurveysIndexPage.objects.first().add_child(instance=self.survey)
+        self.user = get_user_model().objects.create_user(
+            username='tester', password='tester')
+        self.archive_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.archive_dir)
+
+    def create_submission(self, days_ago, **kwargs):
+        submission = MoloSurveySubmission.objects.create(
+            page=self.survey, form_data='{"question-1": "answer"}', **kwargs)
+        MoloSurveySubmission.objects.filter(pk=submission.pk).update(
+            created_at=timezone.now() - datetime.timedelta(days=days_ago))
+        return submission
+
+    def test_expired_submissions_are_archived_and_deleted(self):
+        expired = [self.create_submission(40, user=self.user),
+                   self.create_submission(75)]
+        kept = self.create_submission(10)
+
+        with self.settings(SURVEYS_ARCHIVE_DIR=self.archive_dir):
+            self.assertEqual(
+                purge_expired_submissions(batch_size=1),
+                {self.survey.pk: 2})
+
+        self.assertEqual(
+            list(MoloSurveySubmission.objects.all()), [kept])
+
+        archived = []
+        for root, dirs, files in os.walk(self.archive_dir):
+            for name in files:
+                archived.extend(read_archived_submissions(
+                    os.path.join(root, name)))
+        self.assertEqual(
+            sorted(submission.pk for submission in archived),
+            [submission.pk for submission in expired])
+
+        data = [submission.get_data() for submission in archived]
+        self.assertEqual(
+            sorted(row['username'] for row in data), ['Anonymous', 'tester'])
+        self.assertEqual(data[0]['question-1'], 'answer')
+
+    def test_archive_dir_must_be_private(self):
+        expired = self.create_submission(40)
+        media_dir = os.path.join(self.archive_dir, 'media')
+
+        with self.assertRaises(ImproperlyConfigured):
+            purge_expired_submissions()
+        with self.settings(SURVEYS_ARCHIVE_DIR=os.path.join(
+                media_dir, 'survey_archives'), MEDIA_ROOT=media_dir):
+            with self.assertRaises(ImproperlyConfigured):
+                purge_expired_submissions()
+
+        self.assertEqual(list(MoloSurveySubmission.objects.all()), [expired])
+
 
 class TestSkipLogicMixin(TestCase, MoloTestCaseMixin):
     def setUp(self):
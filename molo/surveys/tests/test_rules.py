@@ -5,18 +5,24 @@ import pytest
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser
 from django.contrib.sessions.middleware import SessionMiddleware
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.test import TestCase, RequestFactory
 from django.utils import timezone
 from wagtail_personalisation.adapters import get_segment_adapter
+from wagtail_personalisation.models import Segment
+from wagtail_personalisation.rules import AbstractBaseRule
 
 from molo.core.models import ArticlePage, ArticlePageTags, SectionPage, Tag
 from molo.core.tests.base import MoloTestCaseMixin
+from molo.surveys.adapters import get_article_tag_ids
 from molo.surveys.models import SurveysIndexPage
 
 
 from .utils import skip_logic_data
 from ..models import (
+    ArticleTagVisit,
+    MoloSurveySubmissionAnswer,
     PersonalisableSurveyFormField,
     PersonalisableSurvey,
     SegmentUserGroup,
@@ -26,6 +32,7 @@ from ..models import (
 from ..rules import (
     ArticleTagRule,
     GroupMembershipRule,
+    RuleRegistry,
     SurveySubmissionDataRule,
     SurveyResponseRule
 )
@@ -183,6 +190,79 @@ class TestSurveyDataRuleSegmentation(TestCase, MoloTestCaseMixin):
         self.request.user = AnonymousUser()
         self.assertFalse(rule.test_user(self.request))
 
+    def test_field_kind_is_stored_on_save(self):
+        segment = Segment.objects.create(name='Segment')
+        rule = SurveySubmissionDataRule.objects.create(
+            segment=segment, survey=self.survey,
+            operator=SurveySubmissionDataRule.CONTAINS,
+            expected_response='choice 3',
+            field_name=self.checkboxes.clean_name)
+
+        rule = SurveySubmissionDataRule.objects.get(pk=rule.pk)
+        self.assertEqual(rule.field_kind,
+                         SurveySubmissionDataRule.MULTIPLE_CHOICE)
+
+        # Only the submission and its answers are fetched, the survey form
+        # is not built
+        with self.assertNumQueries(2):
+            self.assertTrue(rule.test_user(self.request))
+
+    def test_rule_fails_for_several_submissions(self):
+        self.survey.allow_multiple_submissions_per_user = True
+        form = self.survey.get_form({
+            self.singleline_text.clean_name: 'other text',
+            self.checkboxes.clean_name: ['choice 2'],
+            self.checkbox.clean_name: True,
+            self.number.clean_name: 5,
+        }, page=self.survey, user=self.request.user)
+        self.assertTrue(form.is_valid(), repr(form.errors))
+        self.survey.process_form_submission(form)
+
+        # Answers of both submissions would match together, and the first
+        # one would match on its own
+        for expected_response in ['choice 1,choice 2', 'choice 1']:
+            rule = SurveySubmissionDataRule(
+                survey=self.survey,
+                operator=SurveySubmissionDataRule.CONTAINS,
+                expected_response=expected_response,
+                field_name=self.checkboxes.clean_name)
+
+            self.assertFalse(rule.test_user(self.request))
+
+    def test_rule_for_a_missing_field_does_not_build_the_form(self):
+        segment = Segment.objects.create(name='Segment')
+        rule = SurveySubmissionDataRule.objects.create(
+            segment=segment, survey=self.survey,
+            operator=SurveySubmissionDataRule.CONTAINS,
+            expected_response='text', field_name='removed-field')
+
+        rule = SurveySubmissionDataRule.objects.get(pk=rule.pk)
+        self.assertEqual(rule.field_kind, SurveySubmissionDataRule.MISSING)
+
+        with self.assertNumQueries(0):
+            self.assertFalse(rule.test_user(self.request))
+
+    def test_submission_answers_are_normalised(self):
+        answers = MoloSurveySubmissionAnswer.objects.filter(
+            page=self.survey, user=self.request.user)
+
+        self.assertEqual(
+            sorted(answers.filter(
+                field_name=self.checkboxes.clean_name,
+            ).values_list('value', flat=True)),
+            ['choice 1', 'choice 3'])
+        self.assertEqual(
+            answers.get(field_name=self.checkbox.clean_name).value, '1')
+
+    def test_evaluation_does_not_change_expected_response(self):
+        rule = SurveySubmissionDataRule(
+            survey=self.survey, operator=SurveySubmissionDataRule.CONTAINS,
+            expected_response=' choice 3 , choice 1 ',
+            field_name=self.checkboxes.clean_name)
+
+        self.assertTrue(rule.test_user(self.request))
+        self.assertEqual(rule.expected_response, ' choice 3 , choice 1 ')
+
 
 class TestSurveyResponseRule(TestCase, MoloTestCaseMixin):
     def setUp(self):
@@ -271,6 +351,15 @@ class TestGroupMembershipRuleSegmentation(TestCase, MoloTestCaseMixin):
 
         self.assertFalse(rule.test_user(self.request))
 
+    def test_user_groups_are_loaded_once_per_request(self):
+        group = SegmentUserGroup.objects.create(name='Wagtail-like creatures')
+        rules = [GroupMembershipRule(group=self.group),
+                 GroupMembershipRule(group=group)]
+
+        with self.assertNumQueries(1):
+            self.assertEqual([rule.test_user(self.request) for rule in rules],
+                             [True, False])
+
     def test_user_membership_rule_on_not_logged_in_user(self):
         self.request.user = AnonymousUser()
         rule = GroupMembershipRule(group=self.group)
@@ -280,6 +369,8 @@ class TestGroupMembershipRuleSegmentation(TestCase, MoloTestCaseMixin):
 
 class TestArticleTagRuleSegmentation(TestCase, MoloTestCaseMixin):
     def setUp(self):
+        # Page ids are reused between tests, so forget their cached tags
+        cache.clear()
         # Fabricate a request with a logged-in user
         # so we can use it to test the segment rule
         self.mk_main()
@@ -420,6 +511,151 @@ class TestArticleTagRuleSegmentation(TestCase, MoloTestCaseMixin):
         with self.assertRaises(ValidationError):
             rule.clean()
 
+    def test_tag_visits_are_capped(self):
+        rule = ArticleTagRule(
+            operator=ArticleTagRule.EQUALS,
+            tag=self.tag,
+            count=1,
+        )
+        new_article = self.add_article(title='new article', tags=[self.tag])
+
+        with self.settings(SURVEYS_TAG_VISITS_PER_TAG=1):
+            self.adapter.add_page_visit(self.article)
+            self.adapter.add_page_visit(new_article)
+
+        self.assertTrue(rule.test_user(self.request))
+        self.assertEqual(
+            self.request.session['tag_count'][str(self.tag.id)]['p'],
+            [new_article.path])
+
+    def test_legacy_tag_visits_are_counted(self):
+        rule = ArticleTagRule(
+            operator=ArticleTagRule.EQUALS,
+            tag=self.tag,
+            count=1,
+        )
+        self.request.session['tag_count'] = {
+            str(self.tag.id): {
+                self.article.path: timezone.now().isoformat(),
+            },
+        }
+
+        self.assertTrue(rule.test_user(self.request))
+
+    def test_logged_in_user_visits_are_kept_across_sessions(self):
+        rule = ArticleTagRule(
+            operator=ArticleTagRule.EQUALS,
+            tag=self.tag,
+            count=1,
+        )
+        user = get_user_model().objects.create_user(
+            username='tester', email='tester@example.com', password='tester')
+        self.request.user = user
+
+        self.adapter.add_page_visit(self.article)
+        self.adapter.add_page_visit(self.article)
+
+        request = self.request_factory.get('/')
+        SessionMiddleware().process_request(request)
+        request.user = user
+
+        self.assertEqual(
+            ArticleTagVisit.objects.filter(user=user).count(), 1)
+        self.assertTrue(rule.test_user(request))
+
+    def test_logged_in_user_revisits_are_not_counted_again(self):
+        rule = ArticleTagRule(
+            operator=ArticleTagRule.EQUALS,
+            tag=self.tag,
+            count=1,
+        )
+        user = get_user_model().objects.create_user(
+            username='tester', email='tester@example.com', password='tester')
+        self.request.user = user
+        self.adapter.add_page_visit(self.article)
+
+        # Read the article again in a new session, e.g. on another device
+        request = self.request_factory.get('/')
+        SessionMiddleware().process_request(request)
+        request.user = user
+        get_segment_adapter(request).add_page_visit(self.article)
+
+        self.assertTrue(rule.test_user(request))
+
+    def test_visits_before_logging_in_are_kept(self):
+        rule = ArticleTagRule(
+            operator=ArticleTagRule.EQUALS,
+            tag=self.tag,
+            count=2,
+        )
+        new_article = self.add_article(title='new article', tags=[self.tag])
+        self.adapter.add_page_visit(self.article)
+
+        self.request.user = get_user_model().objects.create_user(
+            username='tester', email='tester@example.com', password='tester')
+        self.adapter.add_page_visit(new_article)
+
+        self.assertTrue(rule.test_user(self.request))
+        self.assertEqual(ArticleTagVisit.objects.filter(
+            user=self.request.user).count(), 2)
+
+    def test_article_tag_ids_are_cached(self):
+        self.assertEqual(get_article_tag_ids(self.article), [self.tag.id])
+
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                get_article_tag_ids(self.article), [self.tag.id])
+
+    def test_publishing_article_updates_cached_tag_ids(self):
+        get_article_tag_ids(self.article)
+        ArticlePageTags.objects.filter(page=self.article).delete()
+        self.article.save_revision().publish()
+
+        self.assertEqual(get_article_tag_ids(self.article), [])
+
+    def test_deleting_tag_invalidates_cached_tag_ids(self):
+        get_article_tag_ids(self.article)
+        self.tag.delete()
+
+        self.assertEqual(get_article_tag_ids(self.article), [])
+
+    def test_removing_article_tag_invalidates_cached_tag_ids(self):
+        get_article_tag_ids(self.article)
+        ArticlePageTags.objects.filter(page=self.article).delete()
+
+        self.assertEqual(get_article_tag_ids(self.article), [])
+
+    def test_adding_article_tag_invalidates_cached_tag_ids(self):
+        other_tag = Tag(title='other')
+        self.tag_index.add_child(instance=other_tag)
+        get_article_tag_ids(self.article)
+        ArticlePageTags.objects.create(page=self.article, tag=other_tag)
+
+        self.assertEqual(
+            sorted(get_article_tag_ids(self.article)),
+            sorted([self.tag.id, other_tag.id]))
+
     def test_visting_non_tagged_page_isnt_error(self):
         self.adapter.add_page_visit(self.main)
         self.assertFalse(self.request.session['tag_count'])
+
+
+class TestRuleRegistry(TestCase):
+    def test_rule_types_are_ordered(self):
+        rules = AbstractBaseRule.__subclasses__()
+
+        self.assertIn(ArticleTagRule, rules)
+        self.assertEqual(
+            rules, sorted(rules, key=lambda rule: rule.order))
+
+    def test_rule_types_are_computed_once(self):
+        self.assertIs(AbstractBaseRule.__subclasses__(),
+                      AbstractBaseRule.__subclasses__())
+
+    def test_register_rule_with_order(self):
+        self.addCleanup(setattr, ArticleTagRule, 'order', ArticleTagRule.order)
+        registry = RuleRegistry()
+        registry.populate()
+        registry.register(ArticleTagRule, order=1)
+
+        self.assertEqual(registry.get_rules()[0], ArticleTagRule)
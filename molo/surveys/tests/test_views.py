@@ -1,7 +1,10 @@
+import json
+
 from bs4 import BeautifulSoup
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.test.client import Client
 from django.utils.text import slugify
 from molo.core.models import Languages, Main, SiteLanguageRelation
@@ -11,6 +14,7 @@ from molo.surveys.models import (
     MoloSurveyPage,
     SurveysIndexPage,
 )
+from molo.surveys.results import get_survey_results
 
 from .utils import skip_logic_data
 
@@ -19,6 +23,7 @@ User = get_user_model()
 
 class TestSurveyViews(TestCase, MoloTestCaseMixin):
     def setUp(self):
+        cache.clear()
         self.client = Client()
         self.mk_main()
         self.main = Main.objects.all().first()
@@ -91,6 +96,83 @@ class TestSurveyViews(TestCase, MoloTestCaseMixin):
         self.assertContains(response, 'share your story yo')
         self.assertNotContains(response, 'Take the Survey')
 
+    def test_retried_submission_is_only_saved_once(self):
+        molo_survey_page, molo_survey_form_field = \
+            self.create_molo_survey_page(
+                parent=self.section_index,
+                allow_multiple_submissions_per_user=True)
+        self.client.login(username='tester', password='tester')
+
+        response = self.client.get(molo_survey_page.url)
+        token = BeautifulSoup(response.content, 'html.parser').find(
+            'input', {'name': 'idempotency_token'})['value']
+
+        data = {
+            molo_survey_form_field.label.lower().replace(' ', '-'): 'python',
+            'idempotency_token': token,
+        }
+        first = self.client.post(molo_survey_page.url, data)
+        retry = self.client.post(molo_survey_page.url, data)
+
+        self.assertEqual(retry.status_code, 302)
+        self.assertEqual(retry['Location'], first['Location'])
+        submissions = molo_survey_page.get_submission_class().objects.filter(
+            page=molo_survey_page)
+        self.assertEqual(submissions.count(), 1)
+        self.assertEqual(submissions.get().idempotency_token, token)
+
+        # A new filling in of the form gets a new token
+        response = self.client.get(molo_survey_page.url)
+        self.assertNotContains(response, token)
+
+    def test_single_submission_is_enforced_by_the_database(self):
+        molo_survey_page, molo_survey_form_field = \
+            self.create_molo_survey_page(parent=self.section_index)
+        data = {
+            molo_survey_form_field.label.lower().replace(' ', '-'): 'python',
+        }
+
+        # Two sessions of the same user both get past the session check
+        other_client = Client()
+        self.client.login(username='tester', password='tester')
+        other_client.login(username='tester', password='tester')
+
+        response = self.client.post(molo_survey_page.url, data)
+        self.assertEqual(response.status_code, 302)
+        response = other_client.post(molo_survey_page.url, data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(
+            response, 'You have already completed this survey.')
+        submissions = molo_survey_page.get_submission_class().objects.filter(
+            page=molo_survey_page)
+        self.assertEqual(submissions.count(), 1)
+        self.assertEqual(submissions.get().single_submission_user, self.user)
+
+    def test_survey_is_closed_when_quota_is_reached(self):
+        molo_survey_page, molo_survey_form_field = \
+            self.create_molo_survey_page(
+                parent=self.section_index, response_quota=1)
+        data = {
+            molo_survey_form_field.label.lower().replace(' ', '-'): 'python',
+        }
+        User.objects.create_user(username='other', password='other')
+
+        self.client.login(username='tester', password='tester')
+        response = self.client.post(molo_survey_page.url, data)
+        self.assertEqual(response.status_code, 302)
+
+        self.client.login(username='other', password='other')
+        response = self.client.get(molo_survey_page.url)
+        self.assertContains(response, 'This survey is closed.')
+        self.assertNotContains(response, molo_survey_form_field.label)
+
+        response = self.client.post(molo_survey_page.url, data)
+        self.assertContains(response, 'This survey is closed.')
+        self.assertEqual(
+            molo_survey_page.get_submission_class().objects.filter(
+                page=molo_survey_page).count(), 1)
+
     def test_anonymous_submissions_not_allowed_by_default(self):
         molo_survey_page, molo_survey_form_field = \
             self.create_molo_survey_page(parent=self.section_index)
@@ -237,6 +319,135 @@ class TestSurveyViews(TestCase, MoloTestCaseMixin):
         self.assertContains(response, molo_survey_form_field.label)
         self.assertContains(response, 'python</span> 50%')
 
+    @override_settings(SURVEYS_LIVE_RESULTS=True)
+    def test_results_are_polled_from_cached_counts(self):
+        molo_survey_page, molo_survey_form_field = \
+            self.create_molo_survey_page(
+                parent=self.section_index,
+                allow_anonymous_submissions=True,
+                allow_multiple_submissions_per_user=True,
+                show_results=True
+            )
+        field_name = molo_survey_form_field.label.lower().replace(' ', '-')
+        results_url = reverse(
+            'molo.surveys:results', args=(molo_survey_page.slug,))
+
+        response = self.client.post(
+            molo_survey_page.url, {field_name: 'python'}, follow=True)
+        self.assertContains(response, 'data-poll-url="%s"' % results_url)
+
+        response = self.client.get(results_url)
+        self.assertIn('max-age=5', response['Cache-Control'])
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(
+            data['results'], {molo_survey_form_field.label: {'python': 1}})
+
+        self.client.post(molo_survey_page.url, {field_name: 'java'})
+        response = self.client.get(results_url)
+        updated = json.loads(response.content.decode('utf-8'))
+        self.assertNotEqual(updated['version'], data['version'])
+        self.assertEqual(
+            updated['results'],
+            {molo_survey_form_field.label: {'python': 1, 'java': 1}})
+
+    @override_settings(
+        SURVEYS_LIVE_RESULTS=True, SURVEYS_RESULTS_MAX_DISTINCT_ANSWERS=2)
+    def test_new_answers_are_counted_without_tallying_again(self):
+        molo_survey_page, molo_survey_form_field = \
+            self.create_molo_survey_page(
+                parent=self.section_index,
+                allow_anonymous_submissions=True,
+                allow_multiple_submissions_per_user=True,
+                show_results=True
+            )
+        field_name = molo_survey_form_field.label.lower().replace(' ', '-')
+        results_url = reverse(
+            'molo.surveys:results', args=(molo_survey_page.slug,))
+
+        self.client.post(molo_survey_page.url, {field_name: 'python'})
+        self.client.get(results_url)
+
+        for answer in ['python', 'java', 'ruby', 'go']:
+            self.client.post(molo_survey_page.url, {field_name: answer})
+        with self.assertNumQueries(0):
+            tally = get_survey_results(molo_survey_page)
+        self.assertEqual(
+            tally['results'],
+            {molo_survey_form_field.label: {
+                'python': 2, 'java': 1, 'Other': 2}})
+
+    def test_live_results_are_off_by_default(self):
+        molo_survey_page, molo_survey_form_field = \
+            self.create_molo_survey_page(
+                parent=self.section_index,
+                allow_anonymous_submissions=True,
+                show_results=True
+            )
+        field_name = molo_survey_form_field.label.lower().replace(' ', '-')
+
+        response = self.client.post(
+            molo_survey_page.url, {field_name: 'python'}, follow=True)
+        self.assertContains(response, 'python</span> 1')
+        self.assertNotContains(response, 'data-poll-url')
+
+        response = self.client.get(reverse(
+            'molo.surveys:results', args=(molo_survey_page.slug,)))
+        self.assertEqual(response.status_code, 404)
+
+    @override_settings(SURVEYS_LIVE_RESULTS=True)
+    def test_checkboxes_results_are_counted_per_option(self):
+        molo_survey_page, molo_survey_form_field = \
+            self.create_molo_survey_page(
+                parent=self.section_index,
+                allow_anonymous_submissions=True,
+                allow_multiple_submissions_per_user=True,
+                show_results=True,
+                show_results_as_percentage=True
+            )
+        molo_survey_form_field.field_type = 'checkboxes'
+        molo_survey_form_field.skip_logic = skip_logic_data(
+            ['cat', 'dog', 'fish'])
+        molo_survey_form_field.save()
+        field_name = molo_survey_form_field.label.lower().replace(' ', '-')
+
+        self.client.post(molo_survey_page.url, {field_name: ['cat', 'dog']})
+        self.client.post(molo_survey_page.url, {field_name: ['cat']})
+
+        response = self.client.get(reverse(
+            'molo.surveys:results', args=(molo_survey_page.slug,)))
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(
+            data['results'],
+            {molo_survey_form_field.label: {'cat': 100, 'dog': 50}})
+
+    @override_settings(SURVEYS_LIVE_RESULTS=True)
+    def test_checkboxes_options_are_counted_as_they_are_submitted(self):
+        molo_survey_page, molo_survey_form_field = \
+            self.create_molo_survey_page(
+                parent=self.section_index,
+                allow_anonymous_submissions=True,
+                allow_multiple_submissions_per_user=True,
+                show_results=True
+            )
+        molo_survey_form_field.field_type = 'checkboxes'
+        molo_survey_form_field.skip_logic = skip_logic_data(
+            ['cat', 'dog', 'fish'])
+        molo_survey_form_field.save()
+        field_name = molo_survey_form_field.label.lower().replace(' ', '-')
+
+        self.client.post(molo_survey_page.url, {field_name: ['cat']})
+        get_survey_results(molo_survey_page)
+
+        self.client.post(molo_survey_page.url, {field_name: ['cat', 'dog']})
+        self.client.post(
+            molo_survey_page.url, {field_name: ['cat', 'dog', 'fish']})
+        with self.assertNumQueries(0):
+            tally = get_survey_results(molo_survey_page)
+        label = molo_survey_form_field.label
+        self.assertEqual(
+            tally['results'], {label: {'cat': 3, 'dog': 2, 'fish': 1}})
+        self.assertEqual(tally['respondents'], {label: 3})
+
     def test_multi_step_option(self):
         molo_survey_page, molo_survey_form_field = \
             self.create_molo_survey_page(
@@ -343,7 +554,7 @@ class TestSurveyViews(TestCase, MoloTestCaseMixin):
         response = self.client.get('/admin/surveys/')
         self.assertContains(
             response,
-            '<h2><a href="/admin/surveys/submissions/%s/">'
+            '<h2><a href="/admin/surveys/submissions/%s/browse/">'
             'Test Survey</a></h2>' % molo_survey_page.pk)
         user = get_user_model().objects.create_superuser(
             username='superuser2',
@@ -353,7 +564,7 @@ class TestSurveyViews(TestCase, MoloTestCaseMixin):
         response = self.client2.get(self.site2.root_url + '/admin/surveys/')
         self.assertNotContains(
             response,
-            '<h2><a href="/admin/surveys/submissions/%s/">'
+            '<h2><a href="/admin/surveys/submissions/%s/browse/">'
             'Test Survey</a></h2>' % molo_survey_page.pk)
 
     def test_no_duplicate_indexes(self):
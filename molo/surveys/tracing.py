@@ -0,0 +1,203 @@
+"""
+Opt-in tracing of segment rule evaluations.
+
+Enable it by listing sinks in the ``SURVEYS_RULE_TRACE_SINKS`` setting::
+
+    SURVEYS_RULE_TRACE_SINKS = [
+        'molo.surveys.tracing.LoggingTraceSink',
+        'molo.surveys.tracing.CacheRingBufferTraceSink',
+    ]
+
+Every rule evaluation, and every segment evaluation as a whole (recorded
+as the ``Segment`` rule), then emits a record with the segment, the rule,
+the wall time, the number of queries and the result. Queries are only
+counted when the connection logs them anyway, with ``DEBUG`` or its
+``force_debug_cursor``, and are None otherwise. The ``rule_traces``
+management command summarises the records kept in the ring buffer.
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.utils.module_loading import import_string
+
+
+logger = logging.getLogger(__name__)
+
+TRACE_BUFFER_INDEX_CACHE_KEY = 'molo.surveys.rule_traces.index'
+TRACE_BUFFER_SLOT_CACHE_KEY = 'molo.surveys.rule_traces.%d'
+
+_sinks = {}
+
+
+class BaseTraceSink(object):
+    def emit(self, record):
+        raise NotImplementedError
+
+
+class LoggingTraceSink(BaseTraceSink):
+    def emit(self, record):
+        logger.info(
+            'segment=%(segment)s rule=%(rule)s:%(rule_id)s '
+            'time=%(time).2fms queries=%(queries)s result=%(result)s',
+            record)
+
+
+def get_trace_buffer_size():
+    return getattr(settings, 'SURVEYS_RULE_TRACE_BUFFER_SIZE', 1000)
+
+
+class CacheRingBufferTraceSink(BaseTraceSink):
+    """
+    Keep the latest records in the cache, shared between processes. Each
+    record gets its own slot from an atomically incremented index, so
+    concurrent writers don't overwrite each other's records.
+    """
+    def emit(self, record):
+        try:
+            index = cache.incr(TRACE_BUFFER_INDEX_CACHE_KEY)
+        except ValueError:
+            cache.add(TRACE_BUFFER_INDEX_CACHE_KEY, 0, None)
+            index = cache.incr(TRACE_BUFFER_INDEX_CACHE_KEY)
+        slot = (index - 1) % get_trace_buffer_size()
+        cache.set(TRACE_BUFFER_SLOT_CACHE_KEY % slot, record, None)
+
+
+def get_trace_sinks():
+    paths = tuple(getattr(settings, 'SURVEYS_RULE_TRACE_SINKS', ()))
+    if paths not in _sinks:
+        _sinks[paths] = [import_string(path)() for path in paths]
+    return _sinks[paths]
+
+
+def get_traces():
+    """The records in the ring buffer, oldest first."""
+    size = get_trace_buffer_size()
+    index = cache.get(TRACE_BUFFER_INDEX_CACHE_KEY) or 0
+    keys = [TRACE_BUFFER_SLOT_CACHE_KEY % (i % size)
+            for i in range(max(index - size, 0), index)]
+    records = cache.get_many(keys)
+    return [records[key] for key in keys if key in records]
+
+
+def clear_traces():
+    cache.delete_many(
+        [TRACE_BUFFER_INDEX_CACHE_KEY] +
+        [TRACE_BUFFER_SLOT_CACHE_KEY % i
+         for i in range(get_trace_buffer_size())])
+
+
+def count_queries():
+    """
+    Number of queries logged on this thread's connection, or None when
+    it doesn't log them. Unlike CaptureQueriesContext this neither opens
+    a connection nor turns the debug cursor on.
+    """
+    if not connection.queries_logged:
+        return None
+    return len(connection.queries_log)
+
+
+def trace(func, segment_id, name, object_id, request=None, parent=None):
+    """
+    Call ``func``, emitting a trace record when sinks are set.
+
+    Traces given a ``request`` are made available to the traces nested in
+    them as ``request._rule_trace``. Nested traces that run on another
+    thread, like rules evaluated on the rule pool, pass it as ``parent``
+    to add their queries to it.
+    """
+    sinks = get_trace_sinks()
+    if not sinks:
+        return func()
+
+    current = {
+        'thread': threading.current_thread(),
+        'lock': threading.Lock(),
+        'other_queries': 0,
+    }
+    if request is not None:
+        request._rule_trace = current
+    try:
+        queries_before = count_queries()
+        start = time.time()
+        result = func()
+        elapsed = (time.time() - start) * 1000
+        queries_after = count_queries()
+    finally:
+        if request is not None:
+            del request._rule_trace
+
+    query_count = None
+    if queries_before is not None and queries_after is not None:
+        query_count = (
+            queries_after - queries_before + current['other_queries'])
+    if (query_count is not None and parent is not None and
+            parent['thread'] is not current['thread']):
+        with parent['lock']:
+            parent['other_queries'] += query_count
+
+    record = {
+        'segment': segment_id,
+        'rule': name,
+        'rule_id': object_id,
+        'time': elapsed,
+        'queries': query_count,
+        'result': bool(result),
+        'timestamp': start,
+    }
+    for sink in sinks:
+        sink.emit(record)
+
+    return result
+
+
+def evaluate_rule(rule, request):
+    return trace(
+        lambda: rule.test_user(request),
+        getattr(rule, 'segment_id', None),
+        type(rule).__name__,
+        rule.pk,
+        parent=getattr(request, '_rule_trace', None),
+    )
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of sorted values."""
+    if not values:
+        return None
+    index = max(int(round(fraction * len(values))) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+def summarise_traces(records):
+    """
+    Aggregate records per segment and rule into counts, true ratios,
+    average queries, when they were counted, and p50/p95/p99 wall times.
+    """
+    grouped = {}
+    for record in records:
+        key = (record['segment'], record['rule'], record['rule_id'])
+        grouped.setdefault(key, []).append(record)
+
+    summary = []
+    for (segment, rule, rule_id), group in sorted(grouped.items()):
+        times = sorted(record['time'] for record in group)
+        queries = [record['queries'] for record in group
+                   if record['queries'] is not None]
+        summary.append({
+            'segment': segment,
+            'rule': rule,
+            'rule_id': rule_id,
+            'count': len(group),
+            'true': sum(1 for record in group if record['result']),
+            'queries': (
+                float(sum(queries)) / len(queries) if queries else None),
+            'p50': percentile(times, 0.5),
+            'p95': percentile(times, 0.95),
+            'p99': percentile(times, 0.99),
+        })
+    return summary
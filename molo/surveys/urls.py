@@ -1,6 +1,10 @@
 
 from django.conf.urls import url
-from molo.surveys.views import SurveySuccess, submission_article
+from molo.surveys.views import (
+    SurveySuccess,
+    submission_article,
+    survey_results,
+)
 
 
 urlpatterns = [
@@ -9,6 +13,11 @@ urlpatterns = [
         SurveySuccess.as_view(),
         name="success"
     ),
+    url(
+        r"^(?P<slug>[\w-]+)/results/$",
+        survey_results,
+        name="results"
+    ),
     url(
         r'^submissions/(\d+)/article/(\d+)/$',
         submission_article, name='article'),
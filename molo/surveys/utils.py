@@ -1,13 +1,127 @@
 from __future__ import unicode_literals
 
+import base64
+import re
+import zlib
+
+from django.conf import settings
 from django.core.paginator import Page, Paginator
 from django.core.urlresolvers import reverse
+from django.db.models import Q
 from django.shortcuts import redirect
+from django.utils.dateparse import parse_datetime
+from django.utils.encoding import force_text
 from django.utils.functional import cached_property
 
 from .blocks import SkipState
 
 
+def normalise_answer(value):
+    """
+    Flatten a submitted answer into the lower-cased strings stored in the
+    answers table. Empty and false answers are not stored.
+    """
+    if isinstance(value, (list, tuple)):
+        return [v for item in value for v in normalise_answer(item)]
+    if value is True:
+        return ['1']
+    if not value:
+        return []
+    return [force_text(value).lower()]
+
+
+IDEMPOTENCY_TOKEN_FIELD = 'idempotency_token'
+IDEMPOTENCY_TOKEN_RE = re.compile(r'^[0-9a-f]{32}$')
+
+
+def get_idempotency_token(request):
+    """The valid idempotency token posted with a survey form, if any."""
+    token = request.POST.get(IDEMPOTENCY_TOKEN_FIELD, '')
+    if IDEMPOTENCY_TOKEN_RE.match(token):
+        return token
+    return None
+
+
+COMPRESSED_FORM_DATA_PREFIX = 'zlib:'
+
+
+def get_form_data_compression_threshold():
+    """
+    Size in characters above which new submissions' form data is stored
+    compressed, or None when compression is disabled.
+    """
+    if not getattr(settings, 'SURVEYS_COMPRESS_FORM_DATA', False):
+        return None
+    return getattr(settings, 'SURVEYS_COMPRESS_FORM_DATA_THRESHOLD', 1024)
+
+
+def compress_form_data(form_data, threshold=None):
+    """
+    Compress serialised form data longer than ``threshold`` with zlib, as
+    base64 text behind a marker prefix. Form data that would not get any
+    shorter is returned as is.
+    """
+    if threshold is None or len(form_data) <= threshold or \
+            form_data.startswith(COMPRESSED_FORM_DATA_PREFIX):
+        return form_data
+
+    compressed = COMPRESSED_FORM_DATA_PREFIX + base64.b64encode(
+        zlib.compress(form_data.encode('utf-8'), 9)).decode('ascii')
+    if len(compressed) >= len(form_data):
+        return form_data
+    return compressed
+
+
+def decompress_form_data(form_data):
+    if not form_data.startswith(COMPRESSED_FORM_DATA_PREFIX):
+        return form_data
+    return zlib.decompress(base64.b64decode(
+        form_data[len(COMPRESSED_FORM_DATA_PREFIX):])).decode('utf-8')
+
+
+def encode_keyset_cursor(submission):
+    return '%s_%s' % (submission.created_at.isoformat(), submission.pk)
+
+
+def decode_keyset_cursor(value):
+    """Return the (created_at, id) of a cursor, or None if it is invalid."""
+    try:
+        created_at, pk = value.rsplit('_', 1)
+        created_at, pk = parse_datetime(created_at), int(pk)
+    except (AttributeError, TypeError, ValueError):
+        return None
+    if created_at is None:
+        return None
+    return created_at, pk
+
+
+def paginate_by_keyset(queryset, per_page, before=None, after=None):
+    """
+    Page through submissions newest first, seeking on (created_at, id)
+    instead of using an offset so that deep pages are as fast as the
+    first one.
+
+    ``before`` and ``after`` are decoded cursors of the last and first row
+    of the current page. Returns the rows of the page and whether there are
+    newer and older rows.
+    """
+    if after is not None:
+        created_at, pk = after
+        items = list(queryset.filter(
+            Q(created_at__gt=created_at) | Q(created_at=created_at, pk__gt=pk)
+        ).order_by('created_at', 'pk')[:per_page + 1])
+        has_newer = len(items) > per_page
+        return items[:per_page][::-1], has_newer, True
+
+    if before is not None:
+        created_at, pk = before
+        queryset = queryset.filter(
+            Q(created_at__lt=created_at) | Q(created_at=created_at, pk__lt=pk))
+    items = list(queryset.order_by('-created_at', '-pk')[:per_page + 1])
+    has_older = len(items) > per_page
+    return items[:per_page], before is not None, has_older
+
+
 class SkipLogicPaginator(Paginator):
     def __init__(self, object_list, data=dict(), answered=dict()):
         # Create a mutatable version of the query data
@@ -21,7 +135,7 @@ class SkipLogicPaginator(Paginator):
             i + 1 for i, field in enumerate(self.object_list)
             if field.has_skipping or field.page_break
         ]
-        num_questions = self.object_list.count()
+        num_questions = self.count
         if self.page_breaks:
             self.page_breaks.insert(0, 0)
             if self.page_breaks[-1] != num_questions:
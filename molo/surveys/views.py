@@ -1,24 +1,59 @@
 from __future__ import unicode_literals
 
-import json
+import datetime
+
 from wagtail.wagtailcore.models import Page
 
 from django.views.generic import TemplateView
 from molo.surveys.models import MoloSurveyPage, SurveysIndexPage
-from molo.core.models import ArticlePage
 from django.shortcuts import get_object_or_404, redirect
 
-from wagtail.wagtailcore.utils import cautious_slugify
-
+from django.conf import settings
 from django.contrib.auth.models import Group
+from django.core.exceptions import PermissionDenied
 from django.core.urlresolvers import reverse
+from django.http import Http404, JsonResponse
 from django.shortcuts import render
+from django.utils.cache import patch_cache_control
+from django.utils.http import urlencode
 from django.utils.translation import ugettext as _
 
 from wagtail.wagtailadmin import messages
 from wagtail.wagtailadmin.utils import permission_required
+from wagtailsurveys.forms import SelectDateForm
+from wagtailsurveys.models import get_surveys_for_user
 
-from .forms import CSVGroupCreationForm
+from .conversion import get_conversion_progress, make_submission_article
+from .deletion import get_deletion_progress
+from .forms import (
+    CSVGroupCreationForm,
+    SegmentUserGroupImportForm,
+    SubmissionDeletionForm,
+)
+from .importers import (
+    CSVImportError,
+    SegmentUserGroupImporter,
+    get_import_summary,
+    save_csv_upload,
+    set_import_summary,
+)
+from .models import SegmentUserGroup
+from .results import (
+    get_results_for_display,
+    get_results_poll_interval,
+    get_survey_results,
+    live_results_enabled,
+)
+from .tasks import (
+    convert_submissions_to_articles as convert_submissions_task,
+    delete_submissions as delete_submissions_task,
+    import_segment_user_group_csv,
+)
+from .utils import (
+    decode_keyset_cursor,
+    encode_keyset_cursor,
+    paginate_by_keyset,
+)
 
 
 class SurveySuccess(TemplateView):
@@ -34,44 +69,42 @@ class SurveySuccess(TemplateView):
             MoloSurveyPage, slug=kwargs['slug'], id__in=ids)
         results = dict()
         if survey.show_results:
-            # Get information about form fields
-            data_fields = [
-                (field.clean_name, field.label)
-                for field in survey.get_form_fields()
-            ]
-
-            # Get all submissions for current page
-            submissions = (
-                survey.get_submission_class().objects.filter(page=survey))
-            for submission in submissions:
-                data = submission.get_data()
-
-                # Count results for each question
-                for name, label in data_fields:
-                    answer = data.get(name)
-                    if answer is None:
-                        # Something wrong with data.
-                        # Probably you have changed questions
-                        # and now we are receiving answers for old questions.
-                        # Just skip them.
-                        continue
-
-                    if type(answer) is list:
-                        # answer is a list if the field type is 'Checkboxes'
-                        answer = u', '.join(answer)
-
-                    question_stats = results.get(label, {})
-                    question_stats[answer] = question_stats.get(answer, 0) + 1
-                    results[label] = question_stats
-        if survey.show_results_as_percentage:
-            for question, answers in results.items():
-                total = sum(answers.values())
-                for key in answers.keys():
-                    answers[key] = (answers[key] * 100) / total
-        context.update({'self': survey, 'results': results})
+            results = get_results_for_display(
+                survey, get_survey_results(survey))
+        context.update({
+            'self': survey,
+            'results': results,
+            'live_results': live_results_enabled(),
+            'results_poll_interval': get_results_poll_interval(),
+        })
         return context
 
 
+def get_survey_with_results(request, slug):
+    return get_object_or_404(
+        MoloSurveyPage.objects.descendant_of(request.site.root_page),
+        slug=slug, show_results=True)
+
+
+def survey_results(request, slug):
+    """
+    The current results of a survey as JSON, polled by its results page
+    when live results are enabled. Responses may be cached for the poll
+    interval, so a survey's results are tallied at most that often.
+    """
+    if not live_results_enabled():
+        raise Http404
+    survey = get_survey_with_results(request, slug)
+    tally = get_survey_results(survey)
+    response = JsonResponse({
+        'version': tally['version'],
+        'results': get_results_for_display(survey, tally),
+    })
+    patch_cache_control(
+        response, public=True, max_age=get_results_poll_interval())
+    return response
+
+
 def submission_article(request, survey_id, submission_id):
     # get the specific submission entry
     survey_page = get_object_or_404(Page, id=survey_id).specific
@@ -83,14 +116,7 @@ def submission_article(request, survey_id, submission_id):
         survey_index_page = (
             SurveysIndexPage.objects.descendant_of(
                 request.site.root_page).live().first())
-        body = []
-        for value in submission.get_data().values():
-            body.append({"type": "paragraph", "value": str(value)})
-        article = ArticlePage(
-            title='yourwords-entry-%s' % cautious_slugify(submission_id),
-            slug='yourwords-entry-%s' % cautious_slugify(submission_id),
-            body=json.dumps(body)
-        )
+        article = make_submission_article(submission)
         survey_index_page.add_child(instance=article)
         article.save_revision()
         article.unpublish()
@@ -101,6 +127,143 @@ def submission_article(request, survey_id, submission_id):
     return redirect('/admin/pages/%d/edit/' % submission.article_page.id)
 
 
+def convert_submissions_to_articles(request, survey_id):
+    """
+    Convert the selected submissions, or all of them, to articles in the
+    background and show the progress of the conversion.
+    """
+    if not get_surveys_for_user(request.user).filter(id=survey_id).exists():
+        raise PermissionDenied
+
+    survey_page = get_object_or_404(Page, id=survey_id).specific
+
+    if request.method == 'POST':
+        survey_index_page = (
+            SurveysIndexPage.objects.descendant_of(
+                request.site.root_page).live().first())
+        if request.POST.get('all'):
+            submission_ids = None
+        else:
+            submission_ids = [
+                int(pk) for pk in request.POST.getlist('submission')
+                if pk.isdigit()]
+
+        if submission_ids == []:
+            messages.error(request, _("No submissions were selected."))
+            return redirect('wagtailsurveys:list_submissions', survey_id)
+
+        convert_submissions_task.delay(
+            survey_page.pk, survey_index_page.pk, submission_ids)
+        messages.success(request, _(
+            "The submissions are being converted to articles."))
+        return redirect('survey-submissions-convert', survey_id=survey_id)
+
+    return render(request, 'wagtailsurveys/convert_submissions.html', {
+        'survey_page': survey_page,
+        'progress': get_conversion_progress(survey_page.pk),
+    })
+
+
+def list_submissions(request, survey_id):
+    """
+    List a survey's submissions newest first with keyset pagination.
+    Only the columns of the survey's data fields are shown and only the
+    form data of the rows on the page is decoded.
+    """
+    if not get_surveys_for_user(request.user).filter(id=survey_id).exists():
+        raise PermissionDenied
+
+    survey_page = get_object_or_404(Page, id=survey_id).specific
+    data_fields = survey_page.get_data_fields()
+
+    submissions = survey_page.get_submission_class().objects.filter(
+        page=survey_page)
+    filters = {}
+
+    select_date_form = SelectDateForm(request.GET)
+    if select_date_form.is_valid():
+        date_from = select_date_form.cleaned_data.get('date_from')
+        date_to = select_date_form.cleaned_data.get('date_to')
+        if date_from:
+            submissions = submissions.filter(created_at__gte=date_from)
+            filters['date_from'] = date_from.isoformat()
+        if date_to:
+            # created_at is a time, so include the whole last day
+            submissions = submissions.filter(
+                created_at__lt=date_to + datetime.timedelta(days=1))
+            filters['date_to'] = date_to.isoformat()
+
+    field_names = [name for name, label in data_fields]
+    # get_data() always reads the username, even for surveys that don't
+    # show it, so it is fetched with the submissions
+    submissions = submissions.only(
+        'id', 'created_at', 'form_data', 'article_page', 'user__username')
+
+    submissions, has_newer, has_older = paginate_by_keyset(
+        submissions, getattr(settings, 'SURVEYS_SUBMISSIONS_PER_PAGE', 20),
+        before=decode_keyset_cursor(request.GET.get('before')),
+        after=decode_keyset_cursor(request.GET.get('after')))
+
+    data_rows = []
+    for submission in submissions:
+        form_data = submission.get_data()
+        data_rows.append({
+            'model_id': submission.pk,
+            'article_page_id': submission.article_page_id,
+            'fields': [form_data.get(name) for name in field_names],
+        })
+
+    newer_url = older_url = None
+    if submissions and has_newer:
+        newer_url = '?' + urlencode(dict(
+            filters, after=encode_keyset_cursor(submissions[0])))
+    if submissions and has_older:
+        older_url = '?' + urlencode(dict(
+            filters, before=encode_keyset_cursor(submissions[-1])))
+
+    return render(request, 'wagtailsurveys/browse_submissions.html', {
+        'survey_page': survey_page,
+        'select_date_form': select_date_form,
+        'submissions': submissions,
+        'data_headings': [label for name, label in data_fields],
+        'data_rows': data_rows,
+        'csv_query': '?' + urlencode(dict(filters, action='CSV')),
+        'newer_url': newer_url,
+        'older_url': older_url,
+    })
+
+
+def delete_submissions(request, survey_id):
+    """
+    Delete the submissions matching a filter in the background and show
+    the progress of the deletion.
+    """
+    if not get_surveys_for_user(request.user).filter(id=survey_id).exists():
+        raise PermissionDenied
+
+    survey_page = get_object_or_404(Page, id=survey_id).specific
+    if request.method == 'POST':
+        form = SubmissionDeletionForm(request.POST, survey=survey_page)
+        if form.is_valid():
+            delete_submissions_task.delay(
+                survey_page.pk, form.get_filters())
+            messages.success(request, _(
+                "The submissions are being deleted."))
+            return redirect(
+                'survey-submissions-delete', survey_id=survey_page.pk)
+
+        messages.error(request, _(
+            "The submissions could not be deleted due to errors."))
+    else:
+        form = SubmissionDeletionForm(survey=survey_page)
+
+    return render(request, 'wagtailsurveys/delete_submissions.html', {
+        'form': form,
+        'survey_page': survey_page,
+        'progress': get_deletion_progress(survey_page.pk),
+    })
+
+
 # CSV creation views
 @permission_required('auth.add_group')
 def create(request):
@@ -131,3 +294,52 @@ def create(request):
     return render(request, 'csv_group_creation/create.html', {
         'form': form
     })
+
+
+@permission_required('surveys.change_segmentusergroup')
+def import_segment_user_group(request, group_id):
+    group = get_object_or_404(SegmentUserGroup, pk=group_id)
+    if request.method == 'POST':
+        form = SegmentUserGroupImportForm(request.POST, request.FILES)
+        if form.is_valid():
+            csv_file = form.cleaned_data['csv_file']
+            sync = form.cleaned_data['sync']
+            sync_limit = getattr(
+                settings, 'SURVEYS_CSV_IMPORT_SYNC_LIMIT', 1024 * 1024)
+
+            if csv_file.size > sync_limit:
+                # Import large files in the background
+                path = save_csv_upload(csv_file)
+                import_segment_user_group_csv.delay(group.pk, path, sync)
+                messages.success(request, _(
+                    "The file is being imported into '{0}'.").format(group))
+                return redirect(
+                    'segment-user-group-import', group_id=group.pk)
+
+            importer = SegmentUserGroupImporter(group)
+            try:
+                if sync:
+                    importer.sync_csv(csv_file)
+                else:
+                    importer.import_csv(csv_file)
+            except CSVImportError as error:
+                form.add_error('csv_file', str(error))
+            else:
+                set_import_summary(group, importer.get_summary())
+                messages.success(
+                    request,
+                    _("Added {0} and removed {1} user(s) in '{2}'.").format(
+                        importer.added, importer.removed, group))
+                return redirect(
+                    'segment-user-group-import', group_id=group.pk)
+
+        messages.error(request, _(
+            "The users could not be imported due to errors."))
+    else:
+        form = SegmentUserGroupImportForm()
+
+    return render(request, 'segment_user_group/import.html', {
+        'form': form,
+        'group': group,
+        'summary': get_import_summary(group),
+    })
@@ -1,4 +1,5 @@
 from django.conf import settings
+from django.conf.urls import url
 from django.utils.html import format_html_join
 from django.contrib.auth.models import User
 
@@ -9,11 +10,35 @@ from molo.surveys.models import MoloSurveyPage, SurveyTermsConditions
 from molo.core.models import ArticlePage
 
 from .admin import SegmentUserGroupAdmin
+from .views import (
+    convert_submissions_to_articles,
+    delete_submissions,
+    import_segment_user_group,
+    list_submissions,
+)
 
 
 modeladmin_register(SegmentUserGroupAdmin)
 
 
+@hooks.register('register_admin_urls')
+def register_surveys_admin_urls():
+    return [
+        url(r'^surveys/segment-user-groups/(?P<group_id>\d+)/import/$',
+            import_segment_user_group,
+            name='segment-user-group-import'),
+        url(r'^surveys/submissions/(?P<survey_id>\d+)/convert/$',
+            convert_submissions_to_articles,
+            name='survey-submissions-convert'),
+        url(r'^surveys/submissions/(?P<survey_id>\d+)/browse/$',
+            list_submissions,
+            name='survey-submissions-list'),
+        url(r'^surveys/submissions/(?P<survey_id>\d+)/delete/$',
+            delete_submissions,
+            name='survey-submissions-delete'),
+    ]
+
+
 @hooks.register('construct_main_menu')
 def show_surveys_entries_for_users_have_access(request, menu_items):
     if not request.user.is_superuser and not User.objects.filter(